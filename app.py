@@ -2,34 +2,135 @@ from flask import Flask, render_template, request, send_file, jsonify, Response
 from flask_cors import CORS
 import pdfplumber
 import pandas as pd
+import numpy as np
 import re
 import os
 import json
+import hashlib
+import io
+import mmap
+import shutil
+import signal
+import tempfile
+import threading
+import queue
+import multiprocessing
+import uuid
+import sqlite3
+import tarfile
+import zipfile
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
+from functools import lru_cache
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from werkzeug.utils import secure_filename
 import time
 
+try:
+    import fcntl
+    import resource
+except ImportError:  # Windows
+    fcntl = resource = None
+
+try:
+    import regex
+except ImportError:  # patterns then run on re without a time budget
+    regex = None
+
 app = Flask(__name__)
 CORS(app)
 
-# Global progress tracking
+# Progress tracking: per job, plus the most recently started job for clients without a job id
 progress_data = {'current': 0, 'total': 0, 'status': 'idle', 'message': ''}
+job_progress = OrderedDict()
+progress_lock = threading.Lock()
+PROGRESS_HISTORY = 200
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
+JOBS_FOLDER = 'jobs'
+DATA_FOLDER = 'data'
 ALLOWED_EXTENSIONS = {'pdf'}
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+# Single-request /process limits; larger batches use the chunked /jobs protocol
+MAX_BATCH_FILES = 50
+MAX_BATCH_BYTES = 100 * 1024 * 1024
+MAX_KNOWN_HASHES = 5000  # per /known request, the page's selection limit
+MAX_KNOWN_FILES = 1000  # files sent by hash per /process request or upload part
+FILE_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+app.config['JOBS_FOLDER'] = JOBS_FOLDER
+app.config['RESULTS_DB'] = os.path.join(DATA_FOLDER, 'results.db')
+# Preprocessed PDF content (text, tables, word boxes) is cached per file hash and parser settings
+app.config['PARSE_CACHE'] = os.environ.get('PARSE_CACHE', '1') == '1'
+app.config['PARSE_CACHE_FOLDER'] = os.path.join(DATA_FOLDER, 'parse_cache')
+# Long PDFs are preprocessed in page ranges across this many processes (0 or 1 disables)
+app.config['PAGE_WORKERS'] = int(os.environ.get('PAGE_WORKERS', os.cpu_count() or 1))
+app.config['PAGE_PARALLEL_MIN_PAGES'] = int(os.environ.get('PAGE_PARALLEL_MIN_PAGES', 16))
+# PDFs holding several invoices are split into one row per invoice, extracted on this many processes
+app.config['SPLIT_INVOICES'] = os.environ.get('SPLIT_INVOICES', '1') == '1'
+app.config['INVOICE_WORKERS'] = int(os.environ.get('INVOICE_WORKERS', os.cpu_count() or 1))
+# Remember which pattern won each field per layout fingerprint and try it first next time
+app.config['LAYOUT_RULES'] = os.environ.get('LAYOUT_RULES', '1') == '1'
+app.config['LAYOUT_RULES_FILE'] = os.path.join(DATA_FOLDER, 'layout_rules.json')
+# Per-airline hit counts of every fallback pattern; cascades try the most frequent winner first
+app.config['PATTERN_STATS'] = os.environ.get('PATTERN_STATS', '1') == '1'
+app.config['PATTERN_STATS_FILE'] = os.path.join(DATA_FOLDER, 'pattern_stats.json')
+# Time budget of one regex search over a document; a search that runs out counts as no match
+app.config['REGEX_TIMEOUT_MS'] = float(os.environ.get('REGEX_TIMEOUT_MS', 100))
+# Freeze what was learned: layout rules and pattern order are used but never updated
+app.config['LEARNING_FROZEN'] = os.environ.get('LEARNING_FROZEN', '0') == '1'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
+app.config['USE_REGION_TEMPLATES'] = os.environ.get('USE_REGION_TEMPLATES', '1') == '1'
+# Duplicate uploads: 'flag' marks them in the workbook, 'skip' leaves them out, 'off' disables the check
+app.config['DEDUP_MODE'] = os.environ.get('DEDUP_MODE', 'flag')
+app.config['DEDUP_HISTORY_SIZE'] = int(os.environ.get('DEDUP_HISTORY_SIZE', 10000))
+# Each file is extracted in its own worker process with these limits
+app.config['EXTRACTION_ISOLATION'] = os.environ.get('EXTRACTION_ISOLATION', '1') == '1'
+app.config['EXTRACTION_TIMEOUT'] = int(os.environ.get('EXTRACTION_TIMEOUT', 120))  # seconds
+app.config['EXTRACTION_MEMORY_MB'] = int(os.environ.get('EXTRACTION_MEMORY_MB', 1024))
+# Wall-clock budget of a plain (not streamed, not chunked) /process request, kept under
+# the gunicorn --timeout (300 in the Procfile); files not started in time come back
+# as error rows that a repeat of the request with its job_id extracts (0 disables it)
+app.config['REQUEST_DEADLINE'] = int(os.environ.get('REQUEST_DEADLINE', 270))  # seconds
+# Files of one streamed (or ASGI) request extracted at the same time
+app.config['EXTRACTION_WORKERS'] = int(os.environ.get('EXTRACTION_WORKERS', os.cpu_count() or 2))
+# Retention of generated workbooks, job journals, the parse cache and stray uploads
+# (0 disables a quota; interval 0 disables the janitor)
+app.config['OUTPUT_MAX_AGE_HOURS'] = float(os.environ.get('OUTPUT_MAX_AGE_HOURS', 24))
+app.config['OUTPUT_MAX_MB'] = float(os.environ.get('OUTPUT_MAX_MB', 500))
+app.config['JOBS_MAX_AGE_DAYS'] = float(os.environ.get('JOBS_MAX_AGE_DAYS', 30))
+app.config['JOBS_MAX_MB'] = float(os.environ.get('JOBS_MAX_MB', 200))
+app.config['PARSE_CACHE_MAX_AGE_DAYS'] = float(os.environ.get('PARSE_CACHE_MAX_AGE_DAYS', 30))
+app.config['PARSE_CACHE_MAX_MB'] = float(os.environ.get('PARSE_CACHE_MAX_MB', 1000))
+app.config['UPLOAD_ORPHAN_MINUTES'] = float(os.environ.get('UPLOAD_ORPHAN_MINUTES', 30))
+app.config['JANITOR_INTERVAL'] = int(os.environ.get('JANITOR_INTERVAL', 300))  # seconds
+# Chunked uploads: how long one finalize request waits for queued files before answering 202
+app.config['FINALIZE_WAIT'] = int(os.environ.get('FINALIZE_WAIT', 60))  # seconds
+# A claimed spool file untouched this long was left by a killed worker and is processed again
+app.config['CLAIM_STALE_AFTER'] = int(os.environ.get('CLAIM_STALE_AFTER', 600))  # seconds
+# Largest PDF read from a ZIP/tar upload (members are held in memory one at a time)
+app.config['ARCHIVE_MEMBER_MAX_MB'] = int(os.environ.get('ARCHIVE_MEMBER_MAX_MB', 100))
 
 # Create necessary folders
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+os.makedirs(DATA_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return is_archive(filename) or '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
@@ -39,54 +140,961 @@ def request_entity_too_large(error):
 # UNIFIED PDF PREPROCESSING
 # ================================================================================
 
+class PageLayoutIndex:
+    """Word-level spatial index of one page for label/value lookups.
+
+    Words are (text, x0, top, x1, bottom) tuples. They are bucketed into rows by
+    their top coordinate and each row is sorted by x0, so "right of" and "below"
+    queries are bisections instead of regex scans over the page text. Labels
+    are located through a lowercased word -> (row, column) map.
+    """
+
+    def __init__(self, words, row_tolerance=3):
+        self.rows = []
+        self.row_tops = []
+        self.row_x0s = []
+        self.positions = {}
+
+        for word in sorted(words, key=lambda w: (w[2], w[1])):
+            if self.row_tops and word[2] - self.row_tops[-1] <= row_tolerance:
+                self.rows[-1].append(word)
+            else:
+                self.rows.append([word])
+                self.row_tops.append(word[2])
+
+        for row_idx, row in enumerate(self.rows):
+            row.sort(key=lambda w: w[1])
+            self.row_x0s.append([w[1] for w in row])
+            for col_idx, word in enumerate(row):
+                self.positions.setdefault(word[0].lower(), []).append((row_idx, col_idx))
+
+    def words(self):
+        """The indexed words, row by row (enough to rebuild the index)"""
+        return [word for row in self.rows for word in row]
+
+    def find_label(self, label):
+        """Yield (row, first_col, last_col) for each occurrence of a label"""
+        tokens = label.lower().split()
+        for row_idx, col_idx in self.positions.get(tokens[0], []):
+            row = self.rows[row_idx]
+            last_col = col_idx + len(tokens) - 1
+            if last_col < len(row) and all(
+                row[col_idx + i][0].lower() == token for i, token in enumerate(tokens)
+            ):
+                yield row_idx, col_idx, last_col
+
+    def right_of(self, label, pattern):
+        """First word matching pattern to the right of label on the same row"""
+        for row_idx, _, last_col in self.find_label(label):
+            for word in self.rows[row_idx][last_col + 1:]:
+                if re.fullmatch(pattern, word[0]):
+                    return word[0]
+        return None
+
+    def below(self, label, pattern, max_rows=4):
+        """First word matching pattern in the rows under label, overlapping it horizontally"""
+        for row_idx, first_col, last_col in self.find_label(label):
+            row = self.rows[row_idx]
+            left, right = row[first_col][1], row[last_col][3]
+            for below_idx in range(row_idx + 1, min(row_idx + 1 + max_rows, len(self.rows))):
+                below_row = self.rows[below_idx]
+                # Words starting left of the label's right edge, scanned right to left
+                col = bisect_right(self.row_x0s[below_idx], right) - 1
+                while col >= 0 and below_row[col][3] > left:
+                    if re.fullmatch(pattern, below_row[col][0]):
+                        return below_row[col][0]
+                    col -= 1
+        return None
+
+def release_page(page):
+    """Free what a processed pdfplumber page caches: objects, layout, edges and its text map"""
+    page.flush_cache()
+    get_textmap = getattr(page, 'get_textmap', None)
+    if hasattr(get_textmap, 'cache_clear'):
+        get_textmap.cache_clear()
+
+# Formatting noise canonicalized once per document: (name, pattern, replacement)
+TEXT_NORMALIZATIONS = (
+    ('currency', r'(?:\bRs\.?|\bINR|₹)[ \t\u00a0]*(?=\d)', '₹ '),  # Rs. 1,000 / INR1000 / ₹1000 -> ₹ 1000
+    ('grouping', r'(?<=\d),(?=\d)', ''),  # 1,23,456.00 and 123,456.00 -> 123456.00
+    ('dash', r'[\u2010-\u2015\u2212]', '-'),
+    ('space', r'[ \t\u00a0]{2,}|[\t\u00a0]', ' '),  # newlines are kept for line-anchored patterns
+    ('label', r'\bIntergrated\b', None),  # replaced through LABEL_ALIASES
+)
+LABEL_ALIASES = {'Intergrated': 'Integrated'}
+NORMALIZE_PATTERN = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern, _ in TEXT_NORMALIZATIONS))
+NORMALIZE_REPLACEMENTS = {name: replacement for name, _, replacement in TEXT_NORMALIZATIONS}
+
+class NormalizedText:
+    """Document text with currency marks, digit grouping, dashes, spacing and label
+    aliases canonicalized, plus the offset of every character in the original.
+
+    Amount patterns run on `text`, so they need neither currency alternatives
+    nor comma stripping; offsets[i] is where text[i] came from.
+    """
+
+    __slots__ = ('original', 'text', 'offsets')
+
+    def __init__(self, original):
+        self.original = original
+        pieces, offsets, pos = [], array('i'), 0
+        for match in NORMALIZE_PATTERN.finditer(original):
+            start, end = match.span()
+            replacement = NORMALIZE_REPLACEMENTS[match.lastgroup]
+            if replacement is None:
+                replacement = LABEL_ALIASES[match.group()]
+            pieces.append(original[pos:start])
+            offsets.extend(range(pos, start))
+            pieces.append(replacement)
+            offsets.extend([start] * len(replacement))
+            pos = end
+        pieces.append(original[pos:])
+        offsets.extend(range(pos, len(original)))
+        offsets.append(len(original))
+        self.text = ''.join(pieces)
+        self.offsets = offsets
+
+    def original_span(self, start, end):
+        """(start, end) in the original text of text[start:end]"""
+        return self.offsets[start], self.offsets[end]
+
+    def original_text(self, start, end):
+        orig_start, orig_end = self.original_span(start, end)
+        return self.original[orig_start:orig_end]
+
+class NormalizedTable:
+    """A pdfplumber table normalized once for the financial table parser.
+
+    rows holds each row as a tuple of cell strings ('' for empty cells) and
+    lowered the same cells lowercased. header_row is the index of the first
+    row mentioning a tax column (None if there is none) and columns maps
+    taxable / igst / cgst / sgst / total_incl to (column, same_cell): when
+    same_cell is False the amount sits in the column after the label.
+    """
+
+    __slots__ = ('rows', 'lowered', 'header_row', 'columns')
+
+    HEADER_KEYWORDS = ('taxable', 'igst', 'cgst', 'sgst', 'total')
+
+    def __init__(self, rows):
+        self.rows = [tuple(cell if cell else '' for cell in row) for row in rows]
+        self.lowered = [tuple(cell.lower() for cell in row) for row in self.rows]
+        self.header_row = None
+        self.columns = {}
+        if len(self.rows) < 2:
+            return
+        for i, row in enumerate(self.lowered):
+            if any(keyword in cell for cell in row for keyword in self.HEADER_KEYWORDS):
+                self.header_row = i
+                self._map_columns(i)
+                break
+
+    def _map_columns(self, i):
+        for j, cell in enumerate(self.lowered[i]):
+            if not cell:
+                continue
+            # A header such as "IGST\n12%" carries its amount in the same cell
+            has_percent = '%' in cell
+            # Taxable Value - exclude 'Non Taxable' columns
+            if 'taxable' in cell and 'value' in cell and 'non' not in cell:
+                self.columns['taxable'] = (j, True)
+            elif 'igst' in cell:
+                self.columns['igst'] = (j, has_percent)
+            elif 'cgst' in cell:
+                self.columns['cgst'] = (j, has_percent)
+            elif 'sgst' in cell or 'ugst' in cell:
+                self.columns['sgst'] = (j, has_percent)
+            elif 'total' in cell and ('incl' in cell or 'invoice' in cell or 'ticket' in cell):
+                self.columns['total_incl'] = (j, True)
+
+    def data_rows(self, limit=9):
+        """(row, is_total_row) for up to limit rows after the header, skipping label-only sub-headers"""
+        if self.header_row is None:
+            return
+        end = min(self.header_row + 1 + limit, len(self.rows))
+        for i in range(self.header_row + 1, end):
+            cells = [cell for cell in self.rows[i] if cell]
+            if not cells:
+                continue
+            lowered = self.lowered[i]
+            mentions_total = any('total' in cell for cell in lowered)
+            # Skip sub-header rows (e.g., "Taxable*", "Non Taxable*")
+            if not any(char.isdigit() for cell in cells for char in cell) and not mentions_total:
+                continue
+            yield self.rows[i], mentions_total or any('grand' in cell for cell in lowered)
+
+TABLE_SETTINGS = {
+    'vertical_strategy': 'lines',
+    'horizontal_strategy': 'lines',
+    'snap_tolerance': 3,
+    'join_tolerance': 3,
+    'edge_min_length': 3,
+}
+
+def preprocess_page(page, include_tables=True, include_layout=True, release=True):
+    """(text, word boxes or None, table rows) of one pdfplumber page"""
+    page_text = page.extract_text()
+    
+    # Words and tables only need the parsed objects, not pdfminer's layout tree
+    if release:
+        page.flush_cache(['_layout'])
+    
+    # Word boxes reuse the characters parsed for the text above
+    words = None
+    if include_layout:
+        words = [(w['text'], w['x0'], w['top'], w['x1'], w['bottom']) for w in page.extract_words()]
+    
+    # Extract tables with better settings
+    tables = page.extract_tables(TABLE_SETTINGS) if include_tables else []
+    
+    if release:
+        release_page(page)
+    return page_text, words, tables
+
+def nested_workers(configured):
+    """Size of a pool for one file's pages or invoices: configured, but at most the
+    file's share of the CPUs while EXTRACTION_WORKERS files are extracted at once"""
+    share = (os.cpu_count() or 1) // max(app.config['EXTRACTION_WORKERS'], 1)
+    return max(1, min(configured, share))
+
+def _preprocess_page_range(source, start, end, include_tables, include_layout, release):
+    """Page worker: open the PDF (a path or its bytes) and preprocess pages start..end-1"""
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with pdfplumber.open(source) as pdf:
+        return [preprocess_page(pdf.pages[i], include_tables, include_layout, release) for i in range(start, end)]
+
+class PageRange:
+    """Pages start..end-1 of a PDF (a path, in-memory stream or CachedPDF), read as a document of their own"""
+
+    __slots__ = ('source', 'start', 'end')
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+
+def slice_payload(payload, start, end):
+    """The payload of pages start..end-1 cut from a whole-document payload (see to_payload),
+    or None for entries written before tables recorded their page"""
+    if 'table_pages' not in payload:
+        return None
+    kept = [i for i, page in enumerate(payload['table_pages']) if start <= page < end]
+    return {
+        'pages': payload['pages'][start:end],
+        'tables': [payload['tables'][i] for i in kept],
+        'table_pages': [payload['table_pages'][i] - start for i in kept],
+        'layout': payload['layout'][start:end],
+    }
+
 class PDFPreprocessor:
     """Unified PDF preprocessing to standardize data extraction"""
     
+    # Drop each page's parsed objects and layout once its text, words and
+    # tables are taken, so peak memory follows the largest page rather than
+    # the whole document (see bench_memory.py)
+    release_page_caches = True
+    
     def __init__(self, pdf_path):
+        # A PageRange only reads its own pages and caches them under their own kinds
+        self.page_range = None
+        if isinstance(pdf_path, PageRange):
+            self.page_range = (pdf_path.start, pdf_path.end)
+            pdf_path = pdf_path.source
         self.pdf_path = pdf_path
         self.full_text = ''
+        self.page_texts = []
         self.all_tables = []
         self.lines = []
+        self.layout = []
+        self.table_pages = []  # page index (within this document) of each table in all_tables
+        self._file_hash = None
         
-    def extract_content(self):
+    def file_hash(self):
+        """Hash of the PDF for the parse cache (None if the file is unreadable)"""
+        if self._file_hash is None:
+            try:
+                self._file_hash = pdf_source_hash(self.pdf_path)
+            except OSError:
+                pass
+        return self._file_hash
+    
+    def cache_kind(self, kind):
+        return f'{kind}@{self.page_range[0]}-{self.page_range[1]}' if self.page_range else kind
+    
+    def extract_content(self, include_tables=True, include_layout=True):
         """Extract all content from PDF in a standardized way"""
+        file_hash = self.file_hash()
+        # A full parse serves every subset; a text-only parse (airline detection) only itself
+        kinds = ['content'] if include_tables or include_layout else ['content', 'text']
+        for kind in kinds:
+            cached = file_hash and parse_cache.load(file_hash, self.cache_kind(kind))
+            if not cached and file_hash and self.page_range and kind == 'content':
+                # One invoice of a split file: the whole-document parse holds its pages too
+                whole = parse_cache.load(file_hash, 'content')
+                cached = whole and slice_payload(whole, *self.page_range)
+            if cached:
+                self.load_payload(cached, include_tables, include_layout)
+                return
+        if isinstance(self.pdf_path, CachedPDF):
+            raise ParseCacheMiss(file_hash)
+        
         try:
             with pdfplumber.open(self.pdf_path) as pdf:
-                for page in pdf.pages:
-                    # Extract text
-                    page_text = page.extract_text()
+                first, last = self.page_range or (0, len(pdf.pages))
+                ranges = self.page_ranges(first, min(last, len(pdf.pages)))
+                if ranges:
+                    pages = self.preprocess_in_parallel(ranges, include_tables, include_layout)
+                else:
+                    pages = (
+                        preprocess_page(page, include_tables, include_layout, self.release_page_caches)
+                        for page in pdf.pages[first:last]
+                    )
+                for page_index, (page_text, words, tables) in enumerate(pages):
+                    self.page_texts.append(page_text or '')
                     if page_text:
                         self.full_text += page_text + '\n'
-                    
-                    # Extract tables with better settings
-                    tables = page.extract_tables({
-                        'vertical_strategy': 'lines',
-                        'horizontal_strategy': 'lines',
-                        'snap_tolerance': 3,
-                        'join_tolerance': 3,
-                        'edge_min_length': 3,
-                    })
-                    if tables:
-                        self.all_tables.extend(tables)
+                    if include_layout:
+                        self.layout.append(PageLayoutIndex(words))
+                    if include_tables:
+                        self.all_tables.extend(NormalizedTable(table) for table in tables)
+                        self.table_pages.extend(page_index for _ in tables)
                 
                 # Split into lines for line-by-line analysis
                 self.lines = self.full_text.split('\n')
                 
-        except:
-            pass
+        except MemoryError:
+            raise
+        except Exception as e:
+            # A file pdfplumber cannot open or parse becomes an error row, not a blank invoice
+            raise ValueError(f'Could not read PDF: {e}') from e
+        
+        if file_hash and include_tables and include_layout:
+            parse_cache.store(file_hash, self.cache_kind('content'), self.to_payload())
+        elif file_hash and not include_tables and not include_layout:
+            parse_cache.store(file_hash, self.cache_kind('text'), self.to_payload())
+    
+    def page_ranges(self, first, last):
+        """Ranges of pages first..last-1 for the page workers, or None to preprocess in this process"""
+        workers = nested_workers(app.config['PAGE_WORKERS'])
+        if (workers < 2 or last - first < app.config['PAGE_PARALLEL_MIN_PAGES']
+                or multiprocessing.current_process().daemon or self.page_source() is None):
+            return None
+        # Two ranges per worker, so a range of heavy pages does not hold up the rest
+        size = -(-(last - first) // (workers * 2))
+        return [(start, min(start + size, last)) for start in range(first, last, size)]
+    
+    def page_source(self):
+        """What a page worker opens: the file path, or the bytes of an in-memory PDF"""
+        if isinstance(self.pdf_path, (str, os.PathLike)):
+            return self.pdf_path
+        if isinstance(self.pdf_path, io.BytesIO):
+            return self.pdf_path.getvalue()
+        return None
+    
+    def preprocess_in_parallel(self, ranges, include_tables, include_layout):
+        """Per-page results of all ranges, each range on a worker process, in page order"""
+        source = self.page_source()
+        tasks = [(source, start, end, include_tables, include_layout, self.release_page_caches) for start, end in ranges]
+        with extraction_context().Pool(min(nested_workers(app.config['PAGE_WORKERS']), len(ranges))) as pool:
+            for page_results in pool.starmap(_preprocess_page_range, tasks):
+                yield from page_results
+    
+    def to_payload(self):
+        """JSON-ready content: the text, table rows and word boxes of each page"""
+        return {
+            'pages': self.page_texts,
+            'tables': [table.rows for table in self.all_tables],
+            'table_pages': self.table_pages,
+            'layout': [index.words() for index in self.layout],
+        }
     
+    def load_payload(self, payload, include_tables=True, include_layout=True):
+        self.page_texts = payload['pages']
+        self.full_text = ''.join(text + '\n' for text in self.page_texts if text)
+        self.lines = self.full_text.split('\n')
+        if include_tables:
+            self.all_tables = [NormalizedTable(rows) for rows in payload['tables']]
+            self.table_pages = payload.get('table_pages', [])
+        if include_layout:
+            self.layout = [PageLayoutIndex([tuple(word) for word in words]) for words in payload['layout']]
+
+    def extract_regions(self, regions):
+        """Extract text only from the given page regions.
+
+        regions is an iterable of (page_index, (x0, top, x1, bottom)) with the
+        bbox expressed as fractions of the page size. Returns a dict mapping
+        each region to its cropped text.
+        """
+        regions = list(regions)
+        file_hash = self.file_hash()
+        kind = self.cache_kind('regions-' + hashlib.sha256(json.dumps(regions).encode()).hexdigest()[:12])
+        cached = file_hash and parse_cache.load(file_hash, kind)
+        if cached:
+            return {(page_index, tuple(bbox)): text for page_index, bbox, text in cached}
+        if isinstance(self.pdf_path, CachedPDF):
+            raise ParseCacheMiss(file_hash)
+        
+        region_texts = {}
+        try:
+            with pdfplumber.open(self.pdf_path) as pdf:
+                last_page = None
+                first, last = self.page_range or (0, len(pdf.pages))
+                for page_index, bbox in regions:
+                    if first + page_index >= min(last, len(pdf.pages)):
+                        continue
+                    page = pdf.pages[first + page_index]
+                    if last_page is not None and last_page is not page and self.release_page_caches:
+                        release_page(last_page)
+                    last_page = page
+                    x0, top, x1, bottom = page.bbox
+                    width, height = x1 - x0, bottom - top
+                    crop_box = (
+                        x0 + bbox[0] * width,
+                        top + bbox[1] * height,
+                        x0 + bbox[2] * width,
+                        top + bbox[3] * height,
+                    )
+                    region_texts[(page_index, bbox)] = page.crop(crop_box).extract_text() or ''
+        except MemoryError:
+            raise
+        except Exception as e:
+            # An unreadable page or a crop outside it (pdfminer syntax errors, ValueError):
+            # the regions read so far are used, uncached, and extractors fall back to full text
+            print(f"Error extracting regions: {str(e)}")
+            return region_texts
+        
+        if file_hash:
+            parse_cache.store(file_hash, kind, [[page_index, bbox, text] for (page_index, bbox), text in region_texts.items()])
+        return region_texts
+
     def get_content(self):
         """Return all extracted content"""
         return {
             'full_text': self.full_text,
+            'normalized': NormalizedText(self.full_text),
             'tables': self.all_tables,
-            'lines': self.lines
+            'lines': self.lines,
+            'layout': self.layout
         }
 
+# ================================================================================
+# PARSE CACHE (persisted preprocessing output)
+# ================================================================================
+
+PARSE_CACHE_VERSION = 2  # 2: per-page texts
+
+class ParseCacheMiss(LookupError):
+    """The parse cache has no entry for a CachedPDF"""
+
+class CachedPDF:
+    """A PDF known only by its hash; every read must be served by the parse cache"""
+
+    __slots__ = ('file_hash',)
+
+    def __init__(self, file_hash):
+        self.file_hash = file_hash
+
+@lru_cache(maxsize=256)
+def _path_sha256(path, size, mtime_ns):
+    return file_sha256(path)
+
+def pdf_source_hash(pdf_path):
+    """SHA-256 of a PDF given as a path, an in-memory stream or a CachedPDF"""
+    if isinstance(pdf_path, CachedPDF):
+        return pdf_path.file_hash
+    if hasattr(pdf_path, 'getbuffer'):
+        return hashlib.sha256(pdf_path.getbuffer()).hexdigest()
+    # Detection, templates and extractors each open the same file; hash it once
+    st = os.stat(pdf_path)
+    return _path_sha256(os.path.abspath(pdf_path), st.st_size, st.st_mtime_ns)
+
+class ParseCache:
+    """Compressed on-disk cache of what PDFPreprocessor pulls out of a PDF.
+
+    Entries are zlib-compressed JSON stored as <hash[:2]>/<hash>-<kind>-<settings>.z
+    where settings fingerprints the pdfplumber version and TABLE_SETTINGS, so a
+    parser change simply misses older entries. Files are memory-mapped and
+    decompressed straight from the mapping, and written via a temp file and
+    os.replace so concurrent workers never see a partial entry.
+
+    The last few entries are also kept in memory, even with the disk cache
+    off, so the parse extract_records runs to find invoice boundaries also
+    serves airline detection, the extractor and the split invoices (forked
+    workers inherit it).
+    """
+
+    MEMORY_ENTRIES = 4
+
+    def __init__(self, folder, enabled=True):
+        self.folder = folder
+        self.enabled = enabled
+        self.recent = OrderedDict()  # (file hash, kind) -> payload
+        self.recent_lock = threading.Lock()
+        self.settings = hashlib.sha256(json.dumps({
+            'version': PARSE_CACHE_VERSION,
+            'pdfplumber': pdfplumber.__version__,
+            'tables': TABLE_SETTINGS,
+        }, sort_keys=True).encode()).hexdigest()[:12]
+
+    def path(self, file_hash, kind):
+        return os.path.join(self.folder, file_hash[:2], f'{file_hash}-{kind}-{self.settings}.z')
+
+    def load(self, file_hash, kind):
+        with self.recent_lock:
+            payload = self.recent.get((file_hash, kind))
+        if payload is not None or not self.enabled:
+            return payload
+        try:
+            with open(self.path(file_hash, kind), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    payload = json.loads(zlib.decompress(mapped))
+                # A hit refreshes the mtime, so retention evicts the least recently used entries
+                if os.utime in os.supports_fd:
+                    os.utime(f.fileno())
+                return payload
+        except (OSError, ValueError, zlib.error):
+            return None
+
+    def store(self, file_hash, kind, payload):
+        with self.recent_lock:
+            self.recent[(file_hash, kind)] = payload
+            self.recent.move_to_end((file_hash, kind))
+            while len(self.recent) > self.MEMORY_ENTRIES:
+                self.recent.popitem(last=False)
+        if not self.enabled:
+            return
+        path = self.path(file_hash, kind)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8')))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not cache parsed content: {e}")
+
+parse_cache = ParseCache(app.config['PARSE_CACHE_FOLDER'], enabled=app.config['PARSE_CACHE'])
+
+# ================================================================================
+# INVOICE RECORDS
+# ================================================================================
+
+def parse_paise(value):
+    """Parse an amount such as '1,234.50' into integer paise (None if blank or invalid)"""
+    if value is None:
+        return None
+    try:
+        amount = Decimal(str(value).replace(',', '').strip())
+    except InvalidOperation:
+        return None
+    if not amount.is_finite():
+        return None
+    return int((amount * 100).to_integral_value(ROUND_HALF_UP))
+
+def format_paise(paise):
+    """Format integer paise as a plain rupee string ('1234.50')"""
+    sign = '-' if paise < 0 else ''
+    return f"{sign}{abs(paise) // 100}.{abs(paise) % 100:02d}"
+
+INVOICE_DATE_FORMATS = [
+    '%d %b %Y', '%d-%b-%Y', '%d-%b-%y', '%d %B %Y', '%d-%m-%Y',
+    '%d/%m/%Y', '%m/%d/%Y', '%Y-%m-%d', '%d/%m/%y',
+]
+
+def parse_invoice_date(value):
+    """Parse the date formats seen on airline invoices into a date (None if unknown)"""
+    if not value:
+        return None
+    # '16th Nov 2024' -> '16 Nov 2024'
+    value = re.sub(r'^(\d{1,2})(?:st|nd|rd|th)\b', r'\1', str(value).strip())
+    for date_format in INVOICE_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+class InvoiceRecord:
+    """Compact typed invoice row.
+
+    Money is held as integer paise and the invoice date is parsed once, so rows
+    can be summed and compared without re-parsing strings. COLUMNS maps the
+    workbook column names to slots.
+    """
+
+    __slots__ = (
+        'file_name', 'airline', 'gstin', 'customer_gstin', 'number',
+        'customer_name', 'date_text', 'date', 'pnr', 'origin', 'destination',
+        'ticket_number', 'taxable_paise', 'cgst_paise', 'sgst_paise',
+        'igst_paise', 'total_paise', 'tax_summary', 'error', 'file_hash',
+        'duplicate_of', 'derived',
+    )
+
+    COLUMNS = {
+        'File Name': 'file_name',
+        'Airline': 'airline',
+        'GSTIN': 'gstin',
+        'GSTIN of Customer': 'customer_gstin',
+        'Number': 'number',
+        'GSTIN Customer Name': 'customer_name',
+        'Date': 'date_text',
+        'PNR': 'pnr',
+        'From': 'origin',
+        'To': 'destination',
+        'Ticket Number': 'ticket_number',
+        'Taxable Value': 'taxable_paise',
+        'CGST': 'cgst_paise',
+        'SGST': 'sgst_paise',
+        'IGST': 'igst_paise',
+        'Total(Incl Taxes)': 'total_paise',
+        'Tax Summary': 'tax_summary',
+        'Error': 'error',
+        'File Hash': 'file_hash',
+        'Duplicate Of': 'duplicate_of',
+        'Derived': 'derived',
+    }
+    MONEY_SLOTS = ('taxable_paise', 'cgst_paise', 'sgst_paise', 'igst_paise', 'total_paise')
+
+    def __init__(self, **values):
+        for slot in self.__slots__:
+            setattr(self, slot, values.get(slot))
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a record from an extractor's column -> string dict"""
+        values = {}
+        for column, slot in cls.COLUMNS.items():
+            value = data.get(column)
+            if slot in cls.MONEY_SLOTS:
+                value = parse_paise(value)
+            elif value == '':
+                value = None
+            values[slot] = value
+        values['date'] = parse_invoice_date(values['date_text'])
+        record = cls(**values)
+        record.derive_missing_amount()
+        return record
+
+    def derive_missing_amount(self):
+        """Fill a missing taxable value or total from the other one and the taxes.
+
+        The column it fills is kept in derived, so validate_batch can tell a
+        computed amount (which balances by construction) from a printed one.
+        """
+        if self.error:
+            return
+        taxes = (self.cgst_paise or 0) + (self.sgst_paise or 0) + (self.igst_paise or 0)
+        if self.taxable_paise is None and self.total_paise is not None and self.total_paise - taxes > 0:
+            self.taxable_paise = self.total_paise - taxes
+            self.derived = 'Taxable Value'
+        elif self.total_paise is None and self.taxable_paise is not None and self.taxable_paise + taxes > 0:
+            self.total_paise = self.taxable_paise + taxes
+            self.derived = 'Total(Incl Taxes)'
+
+    def to_dict(self):
+        """Return the column -> string dict used by the extractors"""
+        data = {}
+        for column, slot in self.COLUMNS.items():
+            value = getattr(self, slot)
+            if slot in self.MONEY_SLOTS:
+                value = format_paise(value) if value is not None else ''
+            data[column] = value if value is not None else ''
+        return data
+
+class InvoiceBatch:
+    """Columnar container for a batch of InvoiceRecords (one list per slot)"""
+
+    def __init__(self):
+        self.columns = {slot: [] for slot in InvoiceRecord.__slots__}
+
+    def __len__(self):
+        return len(self.columns['file_name'])
+
+    def append(self, record):
+        for slot, column in self.columns.items():
+            column.append(getattr(record, slot))
+
+    def records(self):
+        for i in range(len(self)):
+            yield InvoiceRecord(**{slot: column[i] for slot, column in self.columns.items()})
+
+    def to_dataframe(self):
+        """Workbook-shaped DataFrame with numeric rupee amounts"""
+        frame = {}
+        for column, slot in InvoiceRecord.COLUMNS.items():
+            values = self.columns[slot]
+            if slot in InvoiceRecord.MONEY_SLOTS:
+                frame[column] = pd.array(values, dtype='Int64').astype('float64') / 100
+            else:
+                frame[column] = values
+        return pd.DataFrame(frame)
+
+# ================================================================================
+# GUARDED REGEX (per-search time budget on document text)
+# ================================================================================
+
+@lru_cache(maxsize=2048)
+def compile_pattern(pattern, flags=0):
+    return regex.compile(pattern, flags) if regex else re.compile(pattern, flags)
+
+def regex_budget():
+    """Seconds one search may take, or None when unlimited (or the regex module is missing)"""
+    timeout_ms = app.config['REGEX_TIMEOUT_MS']
+    return timeout_ms / 1000 if regex and timeout_ms > 0 else None
+
+def guarded_search(pattern, text, flags=0):
+    """re.search with the REGEX_TIMEOUT_MS budget; a pattern that runs out of time does not match"""
+    compiled = compile_pattern(pattern, flags)
+    budget = regex_budget()
+    if budget is None:
+        return compiled.search(text)
+    try:
+        return compiled.search(text, timeout=budget)
+    except TimeoutError:
+        print(f"Regex exceeded {budget * 1000:.0f} ms on {len(text)} chars, treated as no match: {pattern}")
+        return None
+
+def guarded_findall(pattern, text, flags=0):
+    """re.findall with the REGEX_TIMEOUT_MS budget ([] if it runs out of time)"""
+    compiled = compile_pattern(pattern, flags)
+    budget = regex_budget()
+    if budget is None:
+        return compiled.findall(text)
+    try:
+        return compiled.findall(text, timeout=budget)
+    except TimeoutError:
+        print(f"Regex exceeded {budget * 1000:.0f} ms on {len(text)} chars, treated as no match: {pattern}")
+        return []
+
+# ================================================================================
+# LAYOUT RULES AND PATTERN STATS (what the field cascades learned)
+# ================================================================================
+
+LAYOUT_FINGERPRINT_LABELS = (
+    'Taxable Value', 'GSTIN', 'PNR', 'Invoice', 'Date', 'Total', 'IGST', 'CGST', 'SGST', 'Ticket',
+)
+LAYOUT_FINGERPRINT_GRID = 10  # points; label positions are snapped to this grid
+LAYOUT_REGION_LINES = (2, 4)  # lines before / after a rule's last match that are searched first
+
+def layout_fingerprint(airline_name, page):
+    """Hash of where the static labels sit on a (first) page, or None if none are found"""
+    marks = []
+    for label in LAYOUT_FINGERPRINT_LABELS:
+        for row, col, _ in page.find_label(label):
+            word = page.rows[row][col]
+            marks.append((label, round(word[1] / LAYOUT_FINGERPRINT_GRID), round(word[2] / LAYOUT_FINGERPRINT_GRID)))
+            break
+    if not marks:
+        return None
+    return hashlib.sha1(json.dumps([airline_name, marks]).encode()).hexdigest()[:16]
+
+class LearnedState:
+    """JSON file of what extraction learned, shared by all worker processes.
+
+    Extraction runs in short-lived worker processes, so the state is
+    reloaded when the file changes on disk, and what a file taught is
+    collected in `pending` and merged into it once by flush() after the
+    file is extracted; subclasses define merge(pending). flush() holds an
+    exclusive lock on `<path>.lock` from the reload to the write, so
+    concurrent workers never overwrite each other. A frozen state is read
+    but never written.
+    """
+
+    def __init__(self, path, enabled=True, frozen=False):
+        self.path = path
+        self.enabled = enabled
+        self.frozen = frozen
+        self.data = {}
+        self.pending = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    @property
+    def learning(self):
+        return self.enabled and not self.frozen
+
+    def _reload(self, force=False):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if force or mtime != self.mtime:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+                self.mtime = mtime
+        except (OSError, ValueError):
+            pass
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(f'{self.path}.lock', 'a') as lock_file:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    self._reload(force=True)
+                    self.merge(self.pending)
+                    self.pending = {}
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(self.data, f, indent=1, sort_keys=True)
+                    os.replace(tmp_path, self.path)
+                    self.mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                print(f"Could not save {os.path.basename(self.path)}: {e}")
+
+class LayoutRuleCache(LearnedState):
+    """Per layout fingerprint, the pattern that produced each field and the line it matched on"""
+
+    def hints(self, fingerprint):
+        """field -> {'pattern', 'line'} for a layout ({} if unknown)"""
+        if not self.enabled or fingerprint is None:
+            return {}
+        with self.lock:
+            self._reload()
+            rules = self.data.get(fingerprint, {})
+        # Rules learned before regions were kept are bare patterns
+        return {field: rule if isinstance(rule, dict) else {'pattern': rule, 'line': None}
+                for field, rule in rules.items()}
+
+    def learn(self, fingerprint, field, pattern, line=None):
+        if not self.learning or fingerprint is None:
+            return
+        rule = {'pattern': pattern, 'line': line}
+        with self.lock:
+            if self.data.get(fingerprint, {}).get(field) != rule:
+                self.pending.setdefault(fingerprint, {})[field] = rule
+
+    def merge(self, pending):
+        for fingerprint, fields in pending.items():
+            self.data.setdefault(fingerprint, {}).update(fields)
+
+class PatternStats(LearnedState):
+    """Per airline and field: how often each pattern decided the cascade.
+
+    {airline: {field: {'runs': n, 'hits': {pattern: n}, 'shadowed': {pattern: n}, 'confirmed': {pattern: n}}}}
+    A hit is a pattern that won in the written order; shadowed counts
+    matches of a promoted pattern that an earlier written pattern
+    overruled, confirmed the checks it passed. After TRUST_AFTER_CHECKS
+    passed checks a promoted pattern is trusted and no longer checked.
+    Pending counts are increments, so flushes of concurrent workers add up.
+    """
+
+    PROMOTE_MIN_HITS = 3
+    TRUST_AFTER_CHECKS = 20
+
+    def order(self, airline, field, patterns):
+        """(patterns that always won when they matched, most hits first, then the rest as written;
+        the promoted patterns that need no check)"""
+        if not self.enabled:
+            return patterns, set()
+        with self.lock:
+            self._reload()
+            entry = self.data.get(airline, {}).get(field)
+        if not entry:
+            return patterns, set()
+        hits, shadowed, confirmed = entry['hits'], entry.get('shadowed', {}), entry.get('confirmed', {})
+        promoted = sorted(
+            (pattern for pattern in patterns
+             if hits.get(pattern, 0) >= self.PROMOTE_MIN_HITS and not shadowed.get(pattern)),
+            key=lambda pattern: -hits[pattern],
+        )
+        trusted = {pattern for pattern in promoted if confirmed.get(pattern, 0) >= self.TRUST_AFTER_CHECKS}
+        return promoted + [pattern for pattern in patterns if pattern not in promoted], trusted
+
+    def _count(self, airline, field, key=None, pattern=None, runs=0):
+        if not self.learning:
+            return
+        with self.lock:
+            entry = self.pending.setdefault(airline, {}).setdefault(
+                field, {'runs': 0, 'hits': {}, 'shadowed': {}, 'confirmed': {}}
+            )
+            entry['runs'] += runs
+            if pattern is not None:
+                entry[key][pattern] = entry[key].get(pattern, 0) + 1
+
+    def record(self, airline, field, pattern):
+        """Count one run of a cascade and its winning pattern (None if nothing matched)"""
+        self._count(airline, field, 'hits', pattern, runs=1)
+
+    def shadow(self, airline, field, pattern):
+        """Count a match of pattern that lost to a pattern written before it"""
+        self._count(airline, field, 'shadowed', pattern)
+
+    def confirm(self, airline, field, pattern):
+        """Count a check in which no pattern written before pattern matched"""
+        self._count(airline, field, 'confirmed', pattern)
+
+    def merge(self, pending):
+        for airline, fields in pending.items():
+            for field, counts in fields.items():
+                entry = self.data.setdefault(airline, {}).setdefault(field, {'runs': 0, 'hits': {}})
+                entry['runs'] += counts['runs']
+                for key in ('hits', 'shadowed', 'confirmed'):
+                    totals = entry.setdefault(key, {})
+                    for pattern, n in counts.get(key, {}).items():
+                        totals[pattern] = totals.get(pattern, 0) + n
+
+    def report(self, airline=None):
+        """Stats for inspection: per airline and field, patterns by hit rate"""
+        with self.lock:
+            self._reload()
+            data = json.loads(json.dumps(self.data))
+        report = {}
+        for name, fields in sorted(data.items()):
+            if airline and not name.lower().startswith(airline.lower()):
+                continue
+            report[name] = {}
+            for field, entry in sorted(fields.items()):
+                runs, shadowed, confirmed = entry['runs'], entry.get('shadowed', {}), entry.get('confirmed', {})
+                report[name][field] = {
+                    'runs': runs,
+                    'misses': runs - sum(entry['hits'].values()),
+                    'patterns': [
+                        {'pattern': pattern, 'hits': n, 'rate': round(n / runs, 3) if runs else 0.0,
+                         'shadowed': shadowed.get(pattern, 0), 'confirmed': confirmed.get(pattern, 0)}
+                        for pattern, n in sorted(entry['hits'].items(), key=lambda item: -item[1])
+                    ],
+                }
+        return report
+
+layout_rules = LayoutRuleCache(app.config['LAYOUT_RULES_FILE'], enabled=app.config['LAYOUT_RULES'],
+                               frozen=app.config['LEARNING_FROZEN'])
+pattern_stats = PatternStats(app.config['PATTERN_STATS_FILE'], enabled=app.config['PATTERN_STATS'],
+                             frozen=app.config['LEARNING_FROZEN'])
+
 # ================================================================================
 # UNIFIED DATA EXTRACTOR
 # ================================================================================
 
+AMOUNT_FIELDS = ('Taxable Value', 'CGST', 'SGST', 'IGST', 'Total(Incl Taxes)')
+GSTIN_PATTERN = r'\d{2}[A-Z]{5}\d{4}[A-Z]{1}[A-Z\d]{1}[Z]{1}[A-Z\d]{1}'
+INVOICE_NUMBER_PATTERNS = [
+    r'Ticket\s*No[:\-]+\s*([0-9]+)',  # Kuwait: Ticket No:- 2296321387874
+    r'Serial\s*No\.?[:\s]+([0-9]+)',  # SriLankan: Serial No.: 2863063312
+    r'(?:Invoice|Tax Invoice|Bill|Receipt)\s*(?:No|Number|#)[:\s]*([A-Z0-9\-/]+)',
+    r'Number[:\s]+([A-Z0-9]+)',
+    r'Invoice\s*No\s*[:\s]*([A-Z0-9]+[/-]\d+[/-]\d+)',
+    r'Invoice\s*Number[:\s]*([A-Z0-9]+)',
+]
+AMOUNT_PATTERN = r'[0-9,]+\.\d{2}'
+# Table columns read by the financial parser: (column, field, whether a total row overrides a value)
+TABLE_AMOUNT_COLUMNS = (
+    ('taxable', 'Taxable Value', False),
+    ('igst', 'IGST', True),
+    ('cgst', 'CGST', True),
+    ('sgst', 'SGST', True),
+    ('total_incl', 'Total(Incl Taxes)', True),
+)
+
+def positive_amount(match):
+    """Amount of a match on normalized text, or None unless it is above zero"""
+    val = match.group(1)
+    try:
+        return val if float(val) > 0 else None
+    except ValueError:
+        return None
+
 class UnifiedDataExtractor:
     """Unified extraction logic for all airlines"""
     
@@ -95,7 +1103,12 @@ class UnifiedDataExtractor:
         self.full_text = content['full_text']
         self.tables = content['tables']
         self.lines = content['lines']
+        self.layout = content.get('layout', [])
+        self.normalized = content.get('normalized') or NormalizedText(self.full_text)
         self.airline_name = airline_name
+        self.fingerprint = layout_fingerprint(airline_name, self.layout[0]) if self.layout else None
+        self.rule_hints = layout_rules.hints(self.fingerprint)
+        self.line_starts = {}  # id(text) -> (text, offsets of its lines)
         
         # Initialize data structure
         self.data = {
@@ -117,10 +1130,84 @@ class UnifiedDataExtractor:
             'Tax Summary': ''
         }
     
+    def line_start(self, text, line):
+        """Offset of a line of text (len(text) past the last line)"""
+        cached = self.line_starts.get(id(text))
+        if cached is None or cached[0] is not text:
+            cached = self.line_starts[id(text)] = (text, [0] + [m.end() for m in re.finditer('\n', text)])
+        starts = cached[1]
+        return starts[line] if line < len(starts) else len(text)
+
+    def first_match(self, field, patterns, flags=re.IGNORECASE, accept=None, text=None):
+        """Value of the first pattern in a cascade whose match is accepted.
+
+        accept(match) returns the value or None to keep going (default: the
+        stripped first group); text defaults to the original document
+        text. If this layout has a rule for the field, its pattern is tried
+        alone, first on the lines around where it matched last time, then on
+        the whole text; only when that fails does the cascade run. The
+        cascade tries the patterns that always won for this airline first,
+        then the rest as written. A winner found out of order is checked
+        against the untried patterns written before it, so the result is the
+        one the written order gives, until it has passed
+        PatternStats.TRUST_AFTER_CHECKS checks; frozen, the learned order is
+        trusted and nothing is recorded.
+        """
+        accept = accept or (lambda match: match.group(1).strip())
+        text = self.full_text if text is None else text
+
+        def attempt(pattern, start=0, end=None):
+            match = guarded_search(pattern, text[start:end] if start or end is not None else text, flags)
+            value = accept(match) if match else None
+            if value is None:
+                return None, None
+            return value, text.count('\n', 0, start + match.start())
+
+        rule = self.rule_hints.get(field)
+        if rule and rule['pattern'] in patterns:
+            value = None
+            if rule['line'] is not None:
+                before, after = LAYOUT_REGION_LINES
+                value, line = attempt(rule['pattern'], self.line_start(text, max(rule['line'] - before, 0)),
+                                      self.line_start(text, rule['line'] + after + 1))
+            if value is None:
+                value, line = attempt(rule['pattern'])
+            if value is not None:
+                layout_rules.learn(self.fingerprint, field, rule['pattern'], line)
+                pattern_stats.record(self.airline_name, field, rule['pattern'])
+                return value
+
+        ordered, trusted = pattern_stats.order(self.airline_name, field, patterns)
+        tried = set()
+        for pattern in ordered:
+            value, line = attempt(pattern)
+            tried.add(pattern)
+            if value is None:
+                continue
+            if not pattern_stats.frozen and pattern not in trusted:
+                checked = False
+                for earlier in patterns[:patterns.index(pattern)]:
+                    if earlier in tried:
+                        continue
+                    checked = True
+                    earlier_value, earlier_line = attempt(earlier)
+                    if earlier_value is not None:
+                        pattern_stats.shadow(self.airline_name, field, pattern)
+                        pattern, value, line = earlier, earlier_value, earlier_line
+                        break
+                else:
+                    if checked:
+                        pattern_stats.confirm(self.airline_name, field, pattern)
+            layout_rules.learn(self.fingerprint, field, pattern, line)
+            pattern_stats.record(self.airline_name, field, pattern)
+            return value
+        pattern_stats.record(self.airline_name, field, None)
+        return None
+    
     def extract_gstins(self):
         """Extract GSTIN numbers (15 character alphanumeric)"""
         gstin_pattern = r'\b\d{2}[A-Z]{5}\d{4}[A-Z]{1}[A-Z\d]{1}[Z]{1}[A-Z\d]{1}\b'
-        gstins = re.findall(gstin_pattern, self.full_text)
+        gstins = guarded_findall(gstin_pattern, self.full_text)
         if len(gstins) > 0:
             self.data['GSTIN'] = gstins[0]
         if len(gstins) > 1:
@@ -136,31 +1223,16 @@ class UnifiedDataExtractor:
                 r'Reference\s*Document\s*Number\s*[:\-]?\s*([0-9]+)'  # Air India
             ]
         
-        for pattern in patterns:
-            match = re.search(pattern, self.full_text, re.IGNORECASE)
-            if match:
-                self.data['Ticket Number'] = match.group(1).strip()
-                return
-        
-        self.data['Ticket Number'] = ''
+        self.data['Ticket Number'] = self.first_match('Ticket Number', patterns) or ''
     
     def extract_invoice_number(self, patterns=None):
         """Extract invoice number with multiple patterns"""
         if patterns is None:
-            patterns = [
-                r'Ticket\s*No[:\-]+\s*([0-9]+)',  # Kuwait: Ticket No:- 2296321387874
-                r'Serial\s*No\.?[:\s]+([0-9]+)',  # SriLankan: Serial No.: 2863063312
-                r'(?:Invoice|Tax Invoice|Bill|Receipt)\s*(?:No|Number|#)[:\s]*([A-Z0-9\-/]+)',
-                r'Number[:\s]+([A-Z0-9]+)',
-                r'Invoice\s*No\s*[:\s]*([A-Z0-9]+[/-]\d+[/-]\d+)',
-                r'Invoice\s*Number[:\s]*([A-Z0-9]+)',
-            ]
+            patterns = INVOICE_NUMBER_PATTERNS
         
-        for pattern in patterns:
-            match = re.search(pattern, self.full_text, re.IGNORECASE)
-            if match:
-                self.data['Number'] = match.group(1).strip()
-                break
+        number = self.first_match('Number', patterns)
+        if number is not None:
+            self.data['Number'] = number
     
     def extract_customer_name(self, patterns=None):
         """Extract customer name with multiple patterns"""
@@ -188,16 +1260,15 @@ class UnifiedDataExtractor:
                 r'Bill\s+[Tt]o\s*:\s*([A-Z][A-Z\s&]+(?:LIMITED|LTD|SERVICES|PRIVATE|PVT))',
             ]
         
-        for pattern in patterns:
-            match = re.search(pattern, self.full_text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                customer_name = match.group(1).strip()
-                # Clean up the name - normalize spaces and remove unwanted prefixes
-                customer_name = re.sub(r'\s+', ' ', customer_name)
-                # Remove airline names that might be captured
-                customer_name = re.sub(r'^(Oman Air SAOC|Qatar Airways|Turkish Airlines|Kuwait Airways)\s+', '', customer_name, flags=re.IGNORECASE)
-                self.data['GSTIN Customer Name'] = customer_name
-                break
+        def clean(match):
+            # Clean up the name - normalize spaces and remove unwanted prefixes
+            customer_name = re.sub(r'\s+', ' ', match.group(1).strip())
+            # Remove airline names that might be captured
+            return re.sub(r'^(Oman Air SAOC|Qatar Airways|Turkish Airlines|Kuwait Airways)\s+', '', customer_name, flags=re.IGNORECASE)
+        
+        customer_name = self.first_match('GSTIN Customer Name', patterns, re.IGNORECASE | re.MULTILINE, clean)
+        if customer_name is not None:
+            self.data['GSTIN Customer Name'] = customer_name
     
     def extract_date(self, patterns=None):
         """Extract date with multiple format support"""
@@ -214,11 +1285,9 @@ class UnifiedDataExtractor:
                 (r'\b(\d{1,2}th\s+[A-Za-z]+\s+\d{4})\b', '%dth %B %Y'),  # DDth Month YYYY
             ]
         
-        for pattern, date_format in patterns:
-            match = re.search(pattern, self.full_text, re.IGNORECASE)
-            if match:
-                self.data['Date'] = match.group(1).strip()
-                break
+        date = self.first_match('Date', [pattern for pattern, date_format in patterns])
+        if date is not None:
+            self.data['Date'] = date
     
     def extract_pnr(self, patterns=None):
         """Extract PNR with multiple patterns"""
@@ -231,29 +1300,27 @@ class UnifiedDataExtractor:
                 r'Ticket\s+Reference[:\s]*\n\s*[A-Z]\s+([A-Z0-9]{6})',  # SriLankan format
             ]
         
-        for pattern in patterns:
-            match = re.search(pattern, self.full_text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                self.data['PNR'] = match.group(1).strip()
-                break
+        pnr = self.first_match('PNR', patterns, re.IGNORECASE | re.MULTILINE)
+        if pnr is not None:
+            self.data['PNR'] = pnr
     
     def extract_route(self):
         """Extract From/To airport codes"""
-        # Pattern 1: XXX-XXX or XXX>XXX format
+        # Pattern 1: XXX-XXX or XXX>XXX format (dashes are normalized)
         route_patterns = [
-            r'\b([A-Z]{3})\s*[-–>→]\s*([A-Z]{3})\b',
+            r'\b([A-Z]{3})\s*[->→]\s*([A-Z]{3})\b',
             r'(?:From|Origin|Departure)[:\s]*([A-Z]{3})',
             r'(?:To|Destination|Arrival)[:\s]*([A-Z]{3})',
         ]
         
-        route_match = re.search(route_patterns[0], self.full_text)
+        route_match = guarded_search(route_patterns[0], self.normalized.text)
         if route_match:
             self.data['From'] = route_match.group(1)
             self.data['To'] = route_match.group(2)
         else:
             # Try separate From/To extraction
-            from_match = re.search(route_patterns[1], self.full_text, re.IGNORECASE)
-            to_match = re.search(route_patterns[2], self.full_text, re.IGNORECASE)
+            from_match = guarded_search(route_patterns[1], self.full_text, re.IGNORECASE)
+            to_match = guarded_search(route_patterns[2], self.full_text, re.IGNORECASE)
             if from_match:
                 self.data['From'] = from_match.group(1)
             if to_match:
@@ -262,103 +1329,16 @@ class UnifiedDataExtractor:
     def extract_financial_data_from_tables(self):
         """Enhanced table-based financial data extraction"""
         for table in self.tables:
-            if len(table) < 2:
-                continue
-            
-            # Find header row
-            header_row_idx = None
-            col_map = {}
-            
-            for i, row in enumerate(table):
-                row_text = ' '.join([str(cell).upper() if cell else '' for cell in row])
-                
-                # Identify header by looking for key column names
-                if any(keyword in row_text for keyword in ['TAXABLE', 'IGST', 'CGST', 'SGST', 'TOTAL']):
-                    header_row_idx = i
-                    
-                    # Map columns
-                    for j, cell in enumerate(row):
-                        if cell:
-                            cell_lower = str(cell).lower()
-                            cell_str = str(cell)
-                            # Taxable Value - exclude 'Non Taxable' columns
-                            if 'taxable' in cell_lower and 'value' in cell_lower and 'non' not in cell_lower:
-                                col_map['taxable'] = j
-                            elif 'igst' in cell_lower:
-                                # Check if header already contains amount (with %) or just label
-                                col_map['igst'] = j
-                                col_map['igst_has_percent'] = '%' in cell_str
-                            elif 'cgst' in cell_lower:
-                                col_map['cgst'] = j
-                                col_map['cgst_has_percent'] = '%' in cell_str
-                            elif 'sgst' in cell_lower or 'ugst' in cell_lower:
-                                col_map['sgst'] = j
-                                col_map['sgst_has_percent'] = '%' in cell_str
-                            elif 'total' in cell_lower and ('incl' in cell_lower or 'invoice' in cell_lower or 'ticket' in cell_lower):
-                                col_map['total_incl'] = j
-                    break
-            
-            if header_row_idx is None:
-                continue
-            
-            # Extract data from rows after header
-            for data_row_idx in range(header_row_idx + 1, min(header_row_idx + 10, len(table))):
-                data_row = table[data_row_idx]
-                if not data_row:
-                    continue
-                
-                # Skip rows where all non-None cells are just labels (sub-headers)
-                non_none_cells = [cell for cell in data_row if cell]
-                if not non_none_cells:
-                    continue
-                
-                # Skip sub-header rows (e.g., "Taxable*", "Non Taxable*")
-                row_has_only_labels = all(
-                    not any(char.isdigit() for char in str(cell))
-                    for cell in non_none_cells
-                )
-                if row_has_only_labels and not any('total' in str(cell).lower() for cell in non_none_cells):
-                    continue
-                
-                row_text = ' '.join([str(cell) if cell else '' for cell in data_row])
-                is_total_row = 'total' in row_text.lower() or 'grand' in row_text.lower()
-                
-                # Extract values from mapped columns
-                if 'taxable' in col_map and not self.data['Taxable Value']:
-                    val = self._get_cell_value(data_row, col_map['taxable'])
-                    if val:
-                        self.data['Taxable Value'] = val
-                
-                if 'igst' in col_map:
-                    # If header has % (e.g., "IGST\n12%"), amount is in same column
-                    # Otherwise, amount is usually next column after IGST label
-                    if col_map.get('igst_has_percent', False):
-                        val = self._get_cell_value(data_row, col_map['igst'])
-                    else:
-                        val = self._get_cell_value(data_row, col_map['igst'] + 1 if col_map['igst'] + 1 < len(data_row) else col_map['igst'])
-                    if val and (not self.data['IGST'] or is_total_row):
-                        self.data['IGST'] = val
-                
-                if 'cgst' in col_map:
-                    if col_map.get('cgst_has_percent', False):
-                        val = self._get_cell_value(data_row, col_map['cgst'])
-                    else:
-                        val = self._get_cell_value(data_row, col_map['cgst'] + 1 if col_map['cgst'] + 1 < len(data_row) else col_map['cgst'])
-                    if val and (not self.data['CGST'] or is_total_row):
-                        self.data['CGST'] = val
-                
-                if 'sgst' in col_map:
-                    if col_map.get('sgst_has_percent', False):
-                        val = self._get_cell_value(data_row, col_map['sgst'])
-                    else:
-                        val = self._get_cell_value(data_row, col_map['sgst'] + 1 if col_map['sgst'] + 1 < len(data_row) else col_map['sgst'])
-                    if val and (not self.data['SGST'] or is_total_row):
-                        self.data['SGST'] = val
-                
-                if 'total_incl' in col_map:
-                    val = self._get_cell_value(data_row, col_map['total_incl'])
-                    if val and (not self.data['Total(Incl Taxes)'] or is_total_row):
-                        self.data['Total(Incl Taxes)'] = val
+            for row, is_total_row in table.data_rows():
+                for column, field, total_overrides in TABLE_AMOUNT_COLUMNS:
+                    if column not in table.columns:
+                        continue
+                    col, same_cell = table.columns[column]
+                    if not same_cell and col + 1 < len(row):
+                        col += 1
+                    val = self._get_cell_value(row, col)
+                    if val and (not self.data[field] or (total_overrides and is_total_row)):
+                        self.data[field] = val
     
     def _get_cell_value(self, row, col_idx):
         """Safely extract numeric value from table cell"""
@@ -373,110 +1353,75 @@ class UnifiedDataExtractor:
         return None
     
     def extract_financial_data_from_text(self):
-        """Extract financial data from text using patterns"""
+        """Extract financial data from the normalized text using patterns"""
+        text = self.normalized.text
         # Taxable Value
         if not self.data['Taxable Value']:
             patterns = [
-                r'Taxable\s+Value\s+of\s+Services\s+\(INR\)[\s]*([0-9,]+\.?\d*)',  # Kuwait: Taxable Value of Services (INR) 34,358.00
-                r'996425\s+\d+\s+([0-9,]+)\s+\d+\s+IGST',  # Oman: 996425 0 24576 5 IGST: 1229
-                r'996425\s+₹\s+[0-9,]+\.?\d*\s+₹\s+[0-9,]+\.?\d*\s+₹\s+([0-9,]+\.?\d*)',  # Qatar: 996425 ₹ 68,026.00 ₹ 5,173.00 ₹ 68,026.00
-                r'BZYSW3\s+([0-9,]+)',  # SriLankan: Ticket ref BZYSW3 46500
-                r'996425\s+\d+\s+[A-Z]+\s+\d{2}-[A-Z][a-z]{2}-\d{2}\s+[A-Z]+\s+([0-9,]+\.?\d*)',  # Malaysia: 996425 2322791265500 TKTT 25-Sep-25 ECONOMY 8105.00
-                r'Taxable\s+Value\s+₹[\s\-]*([0-9,]+\.?\d*)',  # Oman header format
-                r'Taxable\s+Value[\s\-]*₹[\s]*([0-9,]+\.?\d*)',  # Qatar header format
-                r'Taxable\s+Value[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'Base\s+Fare[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'996411[^\d]*([0-9,]+\.?\d*)',  # SAC code for air transport
+                r'Taxable\s+Value\s+of\s+Services\s+\(INR\)\s*(\d+\.?\d*)',  # Kuwait: Taxable Value of Services (INR) 34358.00
+                r'996425\s+\d+\s+(\d+)\s+\d+\s+IGST',  # Oman: 996425 0 24576 5 IGST: 1229
+                r'996425\s+₹\s+\d+\.?\d*\s+₹\s+\d+\.?\d*\s+₹\s+(\d+\.?\d*)',  # Qatar: 996425 ₹ 68026.00 ₹ 5173.00 ₹ 68026.00
+                r'996425\s+\d+\s+[A-Z]+\s+\d{2}-[A-Z][a-z]{2}-\d{2}\s+[A-Z]+\s+(\d+\.?\d*)',  # Malaysia: 996425 2322791265500 TKTT 25-Sep-25 ECONOMY 8105.00
+                r'Taxable\s+Value\s+₹[\s\-]*(\d+\.?\d*)',  # Oman header format
+                r'Taxable\s+Value[\s\-]*₹\s*(\d+\.?\d*)',  # Qatar header format
+                r'Taxable\s+Value[:\s]*₹?\s*(\d+\.?\d*)',
+                r'Base\s+Fare[:\s]*₹?\s*(\d+\.?\d*)',
+                r'996411[^\d]*(\d+\.?\d*)',  # SAC code for air transport
             ]
-            for pattern in patterns:
-                match = re.search(pattern, self.full_text, re.IGNORECASE)
-                if match:
-                    val = match.group(1).replace(',', '')
-                    try:
-                        if float(val) > 0:
-                            self.data['Taxable Value'] = val
-                            break
-                    except:
-                        pass
+            val = self.first_match('Taxable Value', patterns, accept=positive_amount, text=text)
+            if val is not None:
+                self.data['Taxable Value'] = val
         
         # IGST
         if not self.data['IGST']:
             patterns = [
-                r'Intergrated\s+Tax\s+\(IGST\)\s+[\d.]+\s+([0-9,]+\.?\d*)',  # Kuwait: Intergrated Tax (IGST) 5 1,718.00 or 0.00
-                r'[\d]+%\s*IGST\s*₹\s*([0-9,]+\.?\d*)',  # Qatar: 5% IGST ₹ 3,402.00
-                r'IGST[:\s]*(?:@\s*)?(?:[\d.]+%)?[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'Integrated\s+Tax[:\s]*([0-9,]+\.?\d*)',
+                r'Integrated\s+Tax\s+\(IGST\)\s+[\d.]+\s+(\d+\.?\d*)',  # Kuwait: Intergrated Tax (IGST) 5 1718.00 or 0.00
+                r'\d+%\s*IGST\s*₹\s*(\d+\.?\d*)',  # Qatar: 5% IGST ₹ 3402.00
+                r'IGST[:\s]*(?:@\s*)?(?:[\d.]+%)?[:\s]*₹?\s*(\d+\.?\d*)',
+                r'Integrated\s+Tax[:\s]*(\d+\.?\d*)',
             ]
-            for pattern in patterns:
-                match = re.search(pattern, self.full_text, re.IGNORECASE)
-                if match:
-                    val = match.group(1).replace(',', '')
-                    try:
-                        if float(val) > 0:
-                            self.data['IGST'] = val
-                            break
-                    except:
-                        pass
+            val = self.first_match('IGST', patterns, accept=positive_amount, text=text)
+            if val is not None:
+                self.data['IGST'] = val
         
         # CGST
         if not self.data['CGST']:
             patterns = [
-                r'Central\s+Tax\s+\(CGST\)\s+[\d.]+\s+([0-9,]+\.?\d*)',  # Kuwait: Central Tax (CGST) 2.5 1,221.00
-                r'Central\s+Tax\s+\(CGST\)\s*[\d.]*\s*([0-9,]+\.?\d*)',  # More flexible whitespace
-                r'CGST[:\s]*(?:@\s*)?(?:[\d.]+%)?[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'Central\s+(?:GST|Tax)[:\s]*([0-9,]+\.?\d*)',
+                r'Central\s+Tax\s+\(CGST\)\s+[\d.]+\s+(\d+\.?\d*)',  # Kuwait: Central Tax (CGST) 2.5 1221.00
+                r'Central\s+Tax\s+\(CGST\)\s*[\d.]*\s*(\d+\.?\d*)',  # More flexible whitespace
+                r'CGST[:\s]*(?:@\s*)?(?:[\d.]+%)?[:\s]*₹?\s*(\d+\.?\d*)',
+                r'Central\s+(?:GST|Tax)[:\s]*(\d+\.?\d*)',
             ]
-            for pattern in patterns:
-                match = re.search(pattern, self.full_text, re.IGNORECASE)
-                if match:
-                    val = match.group(1).replace(',', '')
-                    try:
-                        if float(val) > 0:
-                            self.data['CGST'] = val
-                            break
-                    except:
-                        pass
+            val = self.first_match('CGST', patterns, accept=positive_amount, text=text)
+            if val is not None:
+                self.data['CGST'] = val
         
         # SGST
         if not self.data['SGST']:
             patterns = [
-                r'State\s+Tax\s+\(SGST\)\s+[\d.]+\s+([0-9,]+\.?\d*)',  # Kuwait: State Tax (SGST) 2.5 1,221.00
-                r'State\s+Tax\s+\(SGST\)\s*[\d.]*\s*([0-9,]+\.?\d*)',  # More flexible whitespace
-                r'SGST[:\s]*(?:@\s*)?(?:[\d.]+%)?[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'State\s+(?:GST|Tax)[:\s]*([0-9,]+\.?\d*)',
+                r'State\s+Tax\s+\(SGST\)\s+[\d.]+\s+(\d+\.?\d*)',  # Kuwait: State Tax (SGST) 2.5 1221.00
+                r'State\s+Tax\s+\(SGST\)\s*[\d.]*\s*(\d+\.?\d*)',  # More flexible whitespace
+                r'SGST[:\s]*(?:@\s*)?(?:[\d.]+%)?[:\s]*₹?\s*(\d+\.?\d*)',
+                r'State\s+(?:GST|Tax)[:\s]*(\d+\.?\d*)',
             ]
-            for pattern in patterns:
-                match = re.search(pattern, self.full_text, re.IGNORECASE)
-                if match:
-                    val = match.group(1).replace(',', '')
-                    try:
-                        if float(val) > 0:
-                            self.data['SGST'] = val
-                            break
-                    except:
-                        pass
+            val = self.first_match('SGST', patterns, accept=positive_amount, text=text)
+            if val is not None:
+                self.data['SGST'] = val
         
         # Total (Incl Taxes)
         if not self.data['Total(Incl Taxes)']:
             patterns = [
-                r'Total\s+Invoice\s+Value\s+including\s+taxes\s+([0-9,]+\.?\d*)',  # Kuwait: Total Invoice Value including taxes 40,524.00
-                r'IGST\s*₹\s*[0-9,]+\.?\d*\s*₹\s*([0-9,]+\.?\d*)',  # Qatar: IGST ₹ 3,402.00 ₹ 76,601.00 (last value is total)
-                r'5%\s*₹\s*([0-9,]+\.?\d*)',  # Qatar CGST/SGST: 5% ₹ 72,774.00 (total after percentage)
-                r'Total\s+(?:Ticket\s+)?Value[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'Total\s+Invoice\s+Value[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'Grand\s+Total[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
-                r'(?:Net|Final)\s+Amount[:\s]*(?:Rs\.?|INR|₹)?[\s]*([0-9,]+\.?\d*)',
+                r'Total\s+Invoice\s+Value\s+including\s+taxes\s+(\d+\.?\d*)',  # Kuwait: Total Invoice Value including taxes 40524.00
+                r'IGST\s*₹\s*\d+\.?\d*\s*₹\s*(\d+\.?\d*)',  # Qatar: IGST ₹ 3402.00 ₹ 76601.00 (last value is total)
+                r'5%\s*₹\s*(\d+\.?\d*)',  # Qatar CGST/SGST: 5% ₹ 72774.00 (total after percentage)
+                r'Total\s+(?:Ticket\s+)?Value[:\s]*₹?\s*(\d+\.?\d*)',
+                r'Total\s+Invoice\s+Value[:\s]*₹?\s*(\d+\.?\d*)',
+                r'Grand\s+Total[:\s]*₹?\s*(\d+\.?\d*)',
+                r'(?:Net|Final)\s+Amount[:\s]*₹?\s*(\d+\.?\d*)',
             ]
-            for pattern in patterns:
-                match = re.search(pattern, self.full_text, re.IGNORECASE)
-                if match:
-                    val = match.group(1).replace(',', '')
-                    try:
-                        if float(val) > 0:
-                            self.data['Total(Incl Taxes)'] = val
-                            break
-                    except:
-                        pass
+            val = self.first_match('Total(Incl Taxes)', patterns, accept=positive_amount, text=text)
+            if val is not None:
+                self.data['Total(Incl Taxes)'] = val
     
     def format_tax_summary(self):
         """Format tax summary in the requested format: Country(BookingRef): Tax details"""
@@ -517,26 +1462,21 @@ class UnifiedDataExtractor:
                 if digits:
                     booking_ref = digits[-1][-1] if digits[-1] else ''
             
-            # Format tax information
-            cgst = self.data.get('CGST', '0')
-            sgst = self.data.get('SGST', '0')
-            igst = self.data.get('IGST', '0')
-            
-            # Convert to float for checking
-            cgst_val = float(cgst.replace(',', '')) if cgst and cgst != '0' else 0
-            sgst_val = float(sgst.replace(',', '')) if sgst and sgst != '0' else 0
-            igst_val = float(igst.replace(',', '')) if igst and igst != '0' else 0
+            # Format tax information (amounts in paise)
+            cgst_val = parse_paise(self.data.get('CGST')) or 0
+            sgst_val = parse_paise(self.data.get('SGST')) or 0
+            igst_val = parse_paise(self.data.get('IGST')) or 0
             
             tax_parts = []
             
             if cgst_val > 0 or sgst_val > 0:
                 # Domestic: CGST and SGST
                 total_cgst_sgst = cgst_val + sgst_val
-                tax_parts.append(f"CGST and SGST is {total_cgst_sgst:,.2f}")
+                tax_parts.append(f"CGST and SGST is {total_cgst_sgst / 100:,.2f}")
             
             if igst_val > 0:
                 # International: IGST
-                tax_parts.append(f"IGST is {igst_val:,.2f}")
+                tax_parts.append(f"IGST is {igst_val / 100:,.2f}")
             
             if tax_parts and booking_ref:
                 self.data['Tax Summary'] = f"{country}({booking_ref}): {', '.join(tax_parts)}"
@@ -556,37 +1496,38 @@ class UnifiedDataExtractor:
             self.data['CGST'] = '0'
         if self.data['IGST'] and not self.data['SGST']:
             self.data['SGST'] = '0'
-        
-        # Calculate missing Taxable Value
-        if not self.data['Taxable Value'] and self.data['Total(Incl Taxes)']:
-            try:
-                total_incl = float(self.data['Total(Incl Taxes)'])
-                cgst = float(self.data['CGST']) if self.data['CGST'] else 0
-                sgst = float(self.data['SGST']) if self.data['SGST'] else 0
-                igst = float(self.data['IGST']) if self.data['IGST'] else 0
-                taxable = total_incl - (cgst + sgst + igst)
-                if taxable > 0:
-                    self.data['Taxable Value'] = str(round(taxable, 2))
-            except:
-                pass
-        
-        # Calculate missing Total(Incl Taxes)
-        if not self.data['Total(Incl Taxes)'] and self.data['Taxable Value']:
-            try:
-                taxable = float(self.data['Taxable Value'])
-                cgst = float(self.data['CGST']) if self.data['CGST'] else 0
-                sgst = float(self.data['SGST']) if self.data['SGST'] else 0
-                igst = float(self.data['IGST']) if self.data['IGST'] else 0
-                total_incl = taxable + cgst + sgst + igst
-                if total_incl > 0:
-                    self.data['Total(Incl Taxes)'] = str(round(total_incl, 2))
-            except:
-                pass
+        # A missing Taxable Value or Total(Incl Taxes) is derived when the record is built
+        # (InvoiceRecord.derive_missing_amount), before it is journaled and stored
         
         # Format date for Indigo
         if self.airline_name == 'INDIGO' and self.data['Date']:
             self.data['Date'] = self._format_date_indigo(self.data['Date'])
-    
+
+    def extract_from_layout(self, fields):
+        """Fill fields by looking up values next to their labels (see AIRLINE_LAYOUT_FIELDS)"""
+        for field, (label, direction, pattern) in fields.items():
+            for page in self.layout:
+                if direction == 'right':
+                    value = page.right_of(label, pattern)
+                else:
+                    value = page.below(label, pattern)
+                if value:
+                    if field in AMOUNT_FIELDS:
+                        value = value.replace(',', '')
+                    self.data[field] = value
+                    break
+
+    def extract_from_regions(self, region_texts, fields):
+        """Fill fields from cropped region text (see AIRLINE_REGION_TEMPLATES)"""
+        for field, (region, pattern) in fields.items():
+            match = guarded_search(pattern, region_texts.get(region, ''), re.MULTILINE)
+            if not match:
+                continue
+            value = re.sub(r'\s+', ' ', match.group(1)).strip()
+            if field in AMOUNT_FIELDS:
+                value = value.replace(',', '')
+            self.data[field] = value
+
     def _format_date_indigo(self, date_str):
         """Format date to DD Mon YYYY for Indigo"""
         try:
@@ -628,37 +1569,55 @@ class UnifiedDataExtractor:
 # AIRLINE-SPECIFIC EXTRACTORS (Using Unified System)
 # ================================================================================
 
+# Label lookups on the word layout: field -> (label, 'right' or 'below', value pattern).
+# The regex cascade only runs for fields these lookups leave empty.
+AIRLINE_LAYOUT_FIELDS = {
+    'qatar': {
+        'GSTIN': ('GSTIN of Supplier', 'right', GSTIN_PATTERN),
+        'Number': ('Invoice No', 'right', r'[A-Z0-9]{10,}'),
+        'Date': ('Invoice Date', 'right', r'\d{2}-\d{2}-\d{4}'),
+        'GSTIN of Customer': ('GSTIN/Unique ID of Recipient', 'right', GSTIN_PATTERN),
+        'Ticket Number': ('Ticket/ Document Number', 'right', r'\d{10}'),
+        'Taxable Value': ('Taxable Value', 'below', AMOUNT_PATTERN),
+        'Total(Incl Taxes)': ('Total Invoice', 'below', AMOUNT_PATTERN),
+    },
+    'turkish': {
+        'Number': ('Invoice No', 'right', r'[A-Z0-9]+(?:/[A-Z0-9]+)+'),
+        'Date': ('Invoice Dt', 'right', r'\d{2}-\d{2}-\d{4}'),
+        'Ticket Number': ('Ticket No.', 'below', r'\d{13}'),
+        'Taxable Value': ('Taxable value', 'below', AMOUNT_PATTERN),
+        'Total(Incl Taxes)': ('Total value', 'below', AMOUNT_PATTERN),
+    },
+}
+
 def detect_airline(pdf_path):
-    """Detect airline from PDF content"""
-    try:
-        preprocessor = PDFPreprocessor(pdf_path)
-        preprocessor.extract_content()
-        content = preprocessor.get_content()
-        text_upper = content['full_text'].upper()
-        
-        if 'MALAYSIAN AIRLINES' in text_upper or 'MALAYSIA AIRLINES' in text_upper:
-            return 'malaysia'
-        elif 'TURKISH AIRLINES' in text_upper:
-            return 'turkish'
-        elif 'SRILANKAN AIRLINES' in text_upper or 'SRILANKA' in text_upper:
-            return 'srilankan'
-        elif 'QATAR AIRWAYS' in text_upper:
-            return 'qatar'
-        elif 'OMAN AIR' in text_upper:
-            return 'oman'
-        elif 'KUWAIT AIRWAYS' in text_upper:
-            return 'kuwait'
-        elif 'AIR INDIA EXPRESS' in text_upper:
-            return 'airindiaexpress'
-        elif 'AIR INDIA' in text_upper:
-            return 'airindia'
-        elif 'AKASA' in text_upper or 'AKASA AIR' in text_upper:
-            return 'akasa'
-        elif 'INDIGO' in text_upper or '6E' in text_upper:
-            return 'indigo'
-        else:
-            return 'indigo'
-    except:
+    """Detect airline from PDF content (a PDF that cannot be read raises)"""
+    preprocessor = PDFPreprocessor(pdf_path)
+    preprocessor.extract_content(include_tables=False, include_layout=False)
+    content = preprocessor.get_content()
+    text_upper = content['full_text'].upper()
+    
+    if 'MALAYSIAN AIRLINES' in text_upper or 'MALAYSIA AIRLINES' in text_upper:
+        return 'malaysia'
+    elif 'TURKISH AIRLINES' in text_upper:
+        return 'turkish'
+    elif 'SRILANKAN AIRLINES' in text_upper or 'SRILANKA' in text_upper:
+        return 'srilankan'
+    elif 'QATAR AIRWAYS' in text_upper:
+        return 'qatar'
+    elif 'OMAN AIR' in text_upper:
+        return 'oman'
+    elif 'KUWAIT AIRWAYS' in text_upper:
+        return 'kuwait'
+    elif 'AIR INDIA EXPRESS' in text_upper:
+        return 'airindiaexpress'
+    elif 'AIR INDIA' in text_upper:
+        return 'airindia'
+    elif 'AKASA' in text_upper or 'AKASA AIR' in text_upper:
+        return 'akasa'
+    elif 'INDIGO' in text_upper or '6E' in text_upper:
+        return 'indigo'
+    else:
         return 'indigo'
 
 def extract_data_from_pdf(pdf_path):
@@ -754,17 +1713,23 @@ def extract_data_qatar(pdf_path):
     content = preprocessor.get_content()
     
     extractor = UnifiedDataExtractor(content, 'QATAR AIRWAYS')
-    extractor.extract_gstins()
-    extractor.extract_invoice_number()
+    extractor.extract_from_layout(AIRLINE_LAYOUT_FIELDS['qatar'])
+    # Regex cascade only for fields the layout lookups left empty
+    if not (extractor.data['GSTIN'] and extractor.data['GSTIN of Customer']):
+        extractor.extract_gstins()
+    if not extractor.data['Number']:
+        extractor.extract_invoice_number()
     extractor.extract_customer_name()
-    extractor.extract_date()
+    if not extractor.data['Date']:
+        extractor.extract_date()
     extractor.extract_pnr()
     extractor.extract_route()
     # Qatar-specific ticket number pattern: "Ticket/ Document Number XXXXXXXXXX"
-    extractor.extract_ticket_number([
-        r'Ticket/?\s*Document\s*Number\s+(\d{10})',
-        r'Ticket\s*Number\s*[:\s]*(\d{10})',
-    ])
+    if not extractor.data['Ticket Number']:
+        extractor.extract_ticket_number([
+            r'Ticket/?\s*Document\s*Number\s+(\d{10})',
+            r'Ticket\s*Number\s*[:\s]*(\d{10})',
+        ])
     extractor.extract_financial_data_from_tables()
     extractor.extract_financial_data_from_text()
     extractor.apply_post_extraction_logic()
@@ -794,22 +1759,23 @@ def extract_data_srilankan(pdf_path):
     extractor.extract_pnr()
     extractor.extract_route()
     # Extract taxable value from Sri Lankan format: "Y BZYSW3 46500"
-    taxable_match = re.search(r'[A-Z]\s+[A-Z0-9]{6}\s+([0-9,]+)', content['full_text'])
+    text = extractor.normalized.text
+    taxable_match = guarded_search(r'[A-Z]\s+[A-Z0-9]{6}\s+(\d+)', text)
     if taxable_match:
-        extractor.data['Taxable Value'] = taxable_match.group(1).replace(',', '')
+        extractor.data['Taxable Value'] = taxable_match.group(1)
     # Extract SGST: "SGST 2325"
-    sgst_match = re.search(r'SGST\s+([0-9,]+)', content['full_text'])
+    sgst_match = guarded_search(r'SGST\s+(\d+)', text)
     if sgst_match:
-        extractor.data['SGST'] = sgst_match.group(1).replace(',', '')
+        extractor.data['SGST'] = sgst_match.group(1)
     else:
         extractor.data['SGST'] = '0'
     # Set CGST and IGST to 0 (not present in this format)
     extractor.data['CGST'] = '0'
     extractor.data['IGST'] = '0'
     # Extract total (inc taxes) - appears as number before "Total" text
-    total_match = re.search(r'([0-9,]+)\s*\n\s*Total', content['full_text'], re.IGNORECASE)
+    total_match = guarded_search(r'(\d+)\s*\n\s*Total', text, re.IGNORECASE)
     if total_match:
-        extractor.data['Total(Incl Taxes)'] = total_match.group(1).replace(',', '')
+        extractor.data['Total(Incl Taxes)'] = total_match.group(1)
     extractor.apply_post_extraction_logic()
     extractor.format_tax_summary()
     return extractor.data
@@ -821,17 +1787,22 @@ def extract_data_turkish(pdf_path):
     content = preprocessor.get_content()
     
     extractor = UnifiedDataExtractor(content, 'TURKISH AIRLINES')
+    extractor.extract_from_layout(AIRLINE_LAYOUT_FIELDS['turkish'])
+    # Regex cascade only for fields the layout lookups left empty
     extractor.extract_gstins()
-    extractor.extract_invoice_number()
+    if not extractor.data['Number']:
+        extractor.extract_invoice_number()
     # Extract ticket number with Turkish-specific pattern (appears in table)
-    extractor.extract_ticket_number([
-        r'\b([0-9]{13})\s+\d{2}/\d{2}/\d{2}',  # Turkish table format: 2351821130682 27/03/25
-        r'1\s+([0-9]{13})\s+',  # Alternative: starts with "1 "
-        r'Ticket\s*No[:\s.]+([0-9]{13})',
-        r'E-Ticket\s*No[:\s]+([0-9]{13})',
-    ])
+    if not extractor.data['Ticket Number']:
+        extractor.extract_ticket_number([
+            r'\b([0-9]{13})\s+\d{2}/\d{2}/\d{2}',  # Turkish table format: 2351821130682 27/03/25
+            r'1\s+([0-9]{13})\s+',  # Alternative: starts with "1 "
+            r'Ticket\s*No[:\s.]+([0-9]{13})',
+            r'E-Ticket\s*No[:\s]+([0-9]{13})',
+        ])
     extractor.extract_customer_name()
-    extractor.extract_date()
+    if not extractor.data['Date']:
+        extractor.extract_date()
     extractor.extract_pnr()
     extractor.extract_route()
     extractor.extract_financial_data_from_tables()
@@ -870,11 +1841,1651 @@ def extract_data_akasa(pdf_path):
     return extractor.data
 
 # ================================================================================
-# FLASK ROUTES
+# REGION TEMPLATES (crop-based extraction for stable layouts)
 # ================================================================================
 
-@app.route('/')
-def index():
+# Regions are (page_index, (x0, top, x1, bottom)) with the bbox given as
+# fractions of the page size. Only these crops are text-extracted, which is far
+# cheaper than full-page extract_text plus table detection. Fields missing from
+# 'required' send the file back through the full regex cascade.
+KUWAIT_SUPPLIER = (0, (0.05, 0.17, 0.5, 0.38))
+KUWAIT_RECIPIENT = (0, (0.5, 0.2, 1.0, 0.38))
+KUWAIT_TAXES = (0, (0.05, 0.46, 1.0, 0.625))
+
+SRILANKAN_HEADER = (0, (0.55, 0.155, 0.95, 0.22))
+SRILANKAN_PARTIES = (0, (0.05, 0.24, 0.5, 0.39))
+SRILANKAN_LINES = (0, (0.05, 0.46, 0.95, 0.64))
+
+AIRLINE_REGION_TEMPLATES = {
+    'kuwait': {
+        'airline_name': 'KUWAIT AIRWAYS',
+        'required': ['GSTIN', 'Number', 'Taxable Value', 'Total(Incl Taxes)'],
+        'defaults': {},
+        'fields': {
+            'Number': (KUWAIT_SUPPLIER, r'([A-Z]{3}/[A-Z][a-z]{2}/\d{2}/\d+)'),
+            'Date': (KUWAIT_SUPPLIER, r'\b(\d{1,2}-[A-Za-z]{3}-\d{4})\b'),
+            'GSTIN': (KUWAIT_SUPPLIER, r'GSTIN:\s*(' + GSTIN_PATTERN + r')'),
+            'GSTIN of Customer': (KUWAIT_RECIPIENT, r'GSTIN:\s*(' + GSTIN_PATTERN + r')'),
+            'Ticket Number': (KUWAIT_RECIPIENT, r'Ticket\s*No[:\-]+\s*([0-9]+)'),
+            'GSTIN Customer Name': (KUWAIT_RECIPIENT, r'([A-Z][A-Z\s&]+(?:LIMITED|LTD|SERVICES|PRIVATE|PVT))'),
+            'Taxable Value': (KUWAIT_TAXES, r'Taxable\s+Value\s+of\s+Services\s+\(INR\)\s+([0-9,]+\.\d{2})'),
+            'CGST': (KUWAIT_TAXES, r'\(CGST\)\s+(?:[\d.]+\s+)?([0-9,]+\.\d{2})'),
+            'SGST': (KUWAIT_TAXES, r'\(SGST\)\s+(?:[\d.]+\s+)?([0-9,]+\.\d{2})'),
+            'IGST': (KUWAIT_TAXES, r'\(IGST\)\s+(?:[\d.]+\s+)?([0-9,]+\.\d{2})'),
+            'Total(Incl Taxes)': (KUWAIT_TAXES, r'Total\s+Invoice\s+Value\s+including\s+taxes\s+([0-9,]+\.\d{2})'),
+        },
+    },
+    'srilankan': {
+        'airline_name': 'SRILANKAN AIRLINES',
+        'required': ['GSTIN', 'Number', 'Taxable Value', 'Total(Incl Taxes)'],
+        'defaults': {'CGST': '0', 'SGST': '0', 'IGST': '0'},
+        'fields': {
+            'Number': (SRILANKAN_HEADER, r'Serial\s*No\.?[:\s]+([0-9]+)'),
+            'Ticket Number': (SRILANKAN_HEADER, r'Serial\s*No\.?[:\s]+([0-9]{10})'),
+            'Date': (SRILANKAN_HEADER, r'Date\s*:\s*(\d{1,2}/\d{1,2}/\d{4})'),
+            'GSTIN': (SRILANKAN_PARTIES, r'^GSTIN\s*-\s*(' + GSTIN_PATTERN + r')'),
+            'GSTIN of Customer': (SRILANKAN_PARTIES, r'Unique\s+ID\s*-\s*(' + GSTIN_PATTERN + r')'),
+            'GSTIN Customer Name': (SRILANKAN_PARTIES, r'Bill\s+to\s+Address\s+([A-Z]+)'),
+            # Fare line: class of travel, ticket reference (PNR), amount
+            'PNR': (SRILANKAN_LINES, r'^[A-Z] +([A-Z0-9]{6}) +[0-9,]+$'),
+            'Taxable Value': (SRILANKAN_LINES, r'^[A-Z] +[A-Z0-9]{6} +([0-9,]+)$'),
+            'CGST': (SRILANKAN_LINES, r'^CGST +([0-9,]+)$'),
+            'SGST': (SRILANKAN_LINES, r'^SGST +([0-9,]+)$'),
+            'IGST': (SRILANKAN_LINES, r'^IGST +([0-9,]+)$'),
+            'Total(Incl Taxes)': (SRILANKAN_LINES, r'^([0-9,]+)\s*\n\s*Total'),
+        },
+    },
+}
+
+def extract_data_by_template(pdf_path, airline):
+    """Extract data from the airline's region template.
+
+    Returns None when the airline has no template or a required field could
+    not be read, so the caller can fall back to the full extractor.
+    """
+    template = AIRLINE_REGION_TEMPLATES.get(airline)
+    if not template:
+        return None
+
+    regions = {region for region, _ in template['fields'].values()}
+    preprocessor = PDFPreprocessor(pdf_path)
+    region_texts = preprocessor.extract_regions(regions)
+
+    extractor = UnifiedDataExtractor(preprocessor.get_content(), template['airline_name'])
+    extractor.data.update(template['defaults'])
+    extractor.extract_from_regions(region_texts, template['fields'])
+    if not all(extractor.data[field] for field in template['required']):
+        return None
+
+    extractor.apply_post_extraction_logic()
+    extractor.format_tax_summary()
+    return extractor.data
+
+AIRLINE_EXTRACTORS = {
+    'airindia': extract_data_airindia,
+    'airindiaexpress': extract_data_airindiaexpress,
+    'kuwait': extract_data_kuwait,
+    'oman': extract_data_oman,
+    'qatar': extract_data_qatar,
+    'srilankan': extract_data_srilankan,
+    'turkish': extract_data_turkish,
+    'malaysia': extract_data_malaysia,
+    'akasa': extract_data_akasa,
+    'indigo': extract_data_from_pdf,
+}
+
+def extract_data_for_airline(pdf_path, airline):
+    """Extract data via the airline's region template, else its full extractor"""
+    if app.config['USE_REGION_TEMPLATES']:
+        data = extract_data_by_template(pdf_path, airline)
+        if data is not None:
+            return data
+    # indigo or default
+    data = AIRLINE_EXTRACTORS.get(airline, extract_data_from_pdf)(pdf_path)
+    layout_rules.flush()
+    pattern_stats.flush()
+    return data
+
+def extract_record(pdf_path, filename, airline='auto'):
+    """Extract one uploaded file (a path, or the bytes of an archive member) into an InvoiceRecord; failures become error rows"""
+    detected_airline = None
+    if isinstance(pdf_path, bytes):
+        pdf_path = io.BytesIO(pdf_path)
+    try:
+        # Auto-detect airline if needed
+        if airline == 'auto' or airline == 'any':
+            detected_airline = detect_airline(pdf_path)
+        else:
+            detected_airline = airline
+        extracted_data = extract_data_for_airline(pdf_path, detected_airline)
+        extracted_data['File Name'] = filename
+        return InvoiceRecord.from_dict(extracted_data)
+    except (MemoryError, ParseCacheMiss):
+        raise
+    except Exception as e:
+        return InvoiceRecord(
+            file_name=filename,
+            airline=detected_airline.upper() if detected_airline else 'ERROR',
+            error=str(e)
+        )
+
+# ================================================================================
+# MULTI-INVOICE DOCUMENTS (one row per invoice of a bundled PDF)
+# ================================================================================
+
+# Labels that number an invoice: the generic ones plus the airline formats of the extractors below
+INVOICE_BOUNDARY_PATTERNS = INVOICE_NUMBER_PATTERNS + [
+    r'([A-Z]{3}/[A-Z][a-z]{2}/\d{2}/\d+)',  # Kuwait: MAA/Oct/25/01952
+    r'Debit\s*Note\s*(?:No|Number)[:\s]*([A-Z0-9]+)',  # Air India
+    r'([A-Z]{2}\d{2}[/-]\d+[/-]\d+)',  # Malaysia
+]
+
+def page_invoice_numbers(text):
+    """{label index: number} of the INVOICE_BOUNDARY_PATTERNS found on a page"""
+    numbers = {}
+    for index, pattern in enumerate(INVOICE_BOUNDARY_PATTERNS):
+        match = guarded_search(pattern, text, re.IGNORECASE)
+        if match:
+            numbers[index] = match.group(1).strip()
+    return numbers
+
+def invoice_page_groups(page_texts):
+    """Page ranges [(start, end)] of the invoices in a document, in page order.
+
+    A page that carries a GSTIN header starts the next invoice when a label
+    it shares with the current invoice holds a different number, or when it
+    shares none of its labels (another invoice layout). Pages without any
+    numbering label, or repeating the same numbers, continue the invoice
+    before them.
+    """
+    starts, current = [0], {}
+    for index, text in enumerate(page_texts):
+        numbers = page_invoice_numbers(text)
+        if not numbers:
+            continue
+        shared = numbers.keys() & current.keys()
+        if current and guarded_search(GSTIN_PATTERN, text) and (
+                not shared or any(numbers[label] != current[label] for label in shared)):
+            starts.append(index)
+            current = numbers
+        else:
+            current = {**numbers, **current}
+    return list(zip(starts, starts[1:] + [len(page_texts)]))
+
+def invoice_groups(pdf_path):
+    """Page ranges of the invoices in a PDF, or [] unless it holds more than one.
+
+    This is the file's full parse: parse_cache keeps it, so detection, the
+    extractor and each split invoice read it instead of parsing again.
+    """
+    preprocessor = PDFPreprocessor(pdf_path)
+    preprocessor.extract_content()
+    if not app.config['SPLIT_INVOICES'] or len(preprocessor.page_texts) < 2:
+        return []
+    groups = invoice_page_groups(preprocessor.page_texts)
+    return groups if len(groups) > 1 else []
+
+def part_hash(file_hash, pages):
+    """Identity of one invoice of a split file: the file hash and its 1-based page span"""
+    return f'{file_hash}#p{pages[0] + 1}-{pages[1]}' if pages else file_hash
+
+def split_part_hash(file_hash):
+    """(file hash, page range or None) of a row's File Hash"""
+    base, sep, span = file_hash.partition('#p')
+    if not sep:
+        return file_hash, None
+    first, last = span.split('-')
+    return base, (int(first) - 1, int(last))
+
+def part_file_name(filename, pages):
+    if not pages:
+        return filename
+    if pages[1] - pages[0] == 1:
+        return f'{filename} (page {pages[1]})'
+    return f'{filename} (pages {pages[0] + 1}-{pages[1]})'
+
+def upload_file_name(file_name, pages):
+    """The uploaded file's name from the File Name of one of its invoices (see part_file_name)"""
+    suffix = part_file_name('', pages)
+    return file_name[:-len(suffix)] if suffix and file_name.endswith(suffix) else file_name
+
+def extract_records(pdf_path, filename, airline='auto'):
+    """Extract one uploaded file into [(page range or None, InvoiceRecord)], one per invoice.
+
+    A PDF holding several invoices is split by invoice_page_groups and each
+    page range is extracted as a document of its own, in parallel on
+    INVOICE_WORKERS processes (capped by nested_workers); anything else gives
+    extract_record's one row.
+    """
+    if isinstance(pdf_path, bytes):
+        pdf_path = io.BytesIO(pdf_path)
+    try:
+        groups = invoice_groups(pdf_path)
+    except (MemoryError, ParseCacheMiss):
+        raise
+    except Exception:
+        groups = []  # extract_record turns the failure into an error row
+    if not groups:
+        return [(None, extract_record(pdf_path, filename, airline))]
+    
+    parts = [(PageRange(pdf_path, start, end), part_file_name(filename, (start, end)), airline) for start, end in groups]
+    workers = min(nested_workers(app.config['INVOICE_WORKERS']), len(parts))
+    if workers > 1 and not multiprocessing.current_process().daemon:
+        with extraction_context().Pool(workers) as pool:
+            records = pool.starmap(extract_record, parts)
+    else:
+        records = [extract_record(*part) for part in parts]
+    return list(zip(groups, records))
+
+# ================================================================================
+# ISOLATED EXTRACTION (per-file timeout and memory limit)
+# ================================================================================
+
+# A forked child inherits every lock as it was in the parent, including ones held by
+# other threads at that moment, so fork is used only from a process running a single
+# thread (the CLI, an isolated worker starting its page pools). Threaded servers
+# (gthread, ASGI, stream threads) start workers from a fork server: a clean process
+# that imported this module once and forks each worker from there.
+_start_methods = multiprocessing.get_all_start_methods()
+fork_context = multiprocessing.get_context('fork') if 'fork' in _start_methods else None
+if 'forkserver' in _start_methods:
+    server_context = multiprocessing.get_context('forkserver')
+    server_context.set_forkserver_preload([__name__])
+else:
+    server_context = multiprocessing.get_context('spawn')
+
+def extraction_context():
+    """Multiprocessing context for worker processes started by the current process"""
+    if fork_context is not None and threading.active_count() == 1:
+        return fork_context
+    return server_context
+
+def _isolated_extraction_worker(conn, pdf_path, filename, airline, memory_mb, config):
+    """Worker process body: cap memory, extract, send the records back"""
+    # Lead a process group of its own, so a timeout also kills the pool processes it starts
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    # A worker from the fork server has the settings of import time; use the server's current ones
+    app.config.update(config)
+    if resource is not None and memory_mb:
+        limit = memory_mb * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ValueError, OSError):
+            pass
+    try:
+        conn.send(extract_records(pdf_path, filename, airline))
+    except MemoryError:
+        conn.send([(None, InvoiceRecord(file_name=filename, airline='ERROR',
+                                        error=f'Exceeded memory limit of {memory_mb} MB'))])
+    finally:
+        conn.close()
+
+def extract_records_isolated(pdf_path, filename, airline='auto', timeout=None, memory_mb=None):
+    """Run extract_records in a separate process with a wall-clock and memory limit.
+
+    A PDF that hangs pdfplumber or exhausts memory only costs its own worker;
+    it comes back as an error row and the rest of the batch carries on.
+    """
+    if not app.config['EXTRACTION_ISOLATION']:
+        return extract_records(pdf_path, filename, airline)
+    if timeout is None:
+        timeout = app.config['EXTRACTION_TIMEOUT']
+    if memory_mb is None:
+        memory_mb = app.config['EXTRACTION_MEMORY_MB']
+
+    context = extraction_context()
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    # Not daemonic, so it may start page workers (PAGE_WORKERS); it is always killed with its group below
+    worker = context.Process(
+        target=_isolated_extraction_worker,
+        args=(child_conn, pdf_path, filename, airline, memory_mb, dict(app.config)),
+    )
+    worker.start()
+    child_conn.close()
+    grace = 0
+    try:
+        if parent_conn.poll(timeout):
+            records = parent_conn.recv()
+            grace = 5
+            return records
+        if worker.is_alive():
+            error = f'Timed out after {round(timeout, 1):g}s'
+        else:
+            error = f'Extraction worker exited with code {worker.exitcode}'
+    except EOFError:
+        worker.join(1)
+        error = f'Extraction worker exited with code {worker.exitcode}'
+    finally:
+        parent_conn.close()
+        _stop_isolated_worker(worker, grace)
+    return [(None, InvoiceRecord(file_name=filename, airline='ERROR', error=error))]
+
+def _stop_isolated_worker(worker, grace):
+    """Give an isolated worker grace seconds to exit, then kill its whole process group:
+    page and invoice pool processes would otherwise outlive a killed worker"""
+    worker.join(grace)
+    if hasattr(os, 'killpg'):
+        try:
+            os.killpg(worker.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass  # nothing left in the group (or setsid had not run yet)
+    if worker.is_alive():
+        worker.kill()
+    worker.join()
+
+# ================================================================================
+# BATCH VALIDATION
+# ================================================================================
+
+# Rupees of slack when checking taxable + taxes against the invoice total,
+# since airlines round each tax line separately
+VALIDATION_TOLERANCE = 1.0
+
+def validate_batch(df):
+    """Parse amounts and flag inconsistent rows for a whole batch.
+
+    Runs once over the collected rows using column operations, so the cost does
+    not grow with per-row string parsing. Amount columns come back numeric and
+    a 'Validation' column records the outcome of the consistency check:
+    OK, NON-TAXABLE CHARGES (total includes airport fees and similar pass-through
+    charges), MISMATCH (total is lower than taxable + taxes), INCOMPLETE, ERROR,
+    or DERIVED when the record computed one of the two amounts from the other
+    (see InvoiceRecord.derive_missing_amount), which balances by construction.
+    """
+    amounts = pd.DataFrame({
+        col: df[col] if pd.api.types.is_numeric_dtype(df[col]) else pd.to_numeric(
+            df[col].astype(str).str.replace(',', '', regex=False).str.strip(),
+            errors='coerce'
+        )
+        for col in AMOUNT_FIELDS
+    })
+    taxes = amounts[['CGST', 'SGST', 'IGST']].fillna(0).sum(axis=1)
+    derived = df['Derived'].fillna('').astype(str) if 'Derived' in df.columns else pd.Series('', index=df.index)
+
+    difference = (amounts['Total(Incl Taxes)'] - amounts['Taxable Value'] - taxes).round(2)
+    has_error = df['Error'].notna() if 'Error' in df.columns else pd.Series(False, index=df.index)
+    incomplete = amounts['Taxable Value'].isna() | amounts['Total(Incl Taxes)'].isna()
+
+    df = df.copy()
+    for col in AMOUNT_FIELDS:
+        df[col] = amounts[col]
+    df['Validation'] = np.select(
+        [
+            has_error,
+            incomplete,
+            derived != '',
+            difference.abs() <= VALIDATION_TOLERANCE,
+            difference > 0,
+        ],
+        [
+            'ERROR: ' + df.get('Error', pd.Series('', index=df.index)).astype(str),
+            'INCOMPLETE',
+            'DERIVED ' + derived,
+            'OK',
+            'NON-TAXABLE CHARGES ' + difference.map('{:.2f}'.format),
+        ],
+        default='MISMATCH ' + difference.map('{:.2f}'.format),
+    )
+    return df
+
+# ================================================================================
+# DUPLICATE DETECTION
+# ================================================================================
+
+def file_sha256(path):
+    """Hex SHA-256 of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def invoice_key(record):
+    """Identity of an invoice: supplier GSTIN, invoice number and ticket number (or PNR)"""
+    if not (record.gstin and record.number):
+        return None
+    return '|'.join((record.gstin, record.number, record.ticket_number or record.pnr or ''))
+
+class DuplicateIndex:
+    """Index of already-processed invoices by file hash and invoice key.
+
+    Rows for the most recent max_entries files are kept in a SQLite table
+    (indexed by file hash, base hash of split files and invoice key), so a
+    re-uploaded PDF is answered from history without being parsed again, and
+    every worker process sees and adds to the same history.
+    """
+
+    # Hashes per IN (...) query, below SQLite's default variable limit
+    QUERY_CHUNK = 500
+
+    def __init__(self, path, max_entries, enabled=True, legacy_path=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        if not enabled:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # seq orders rows by last use; base_hash is the file hash of a split file's parts
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS dedup_history (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'file_hash TEXT NOT NULL UNIQUE, base_hash TEXT NOT NULL, invoice_key TEXT, row TEXT NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_dedup_base_hash ON dedup_history (base_hash)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_dedup_invoice_key ON dedup_history (invoice_key)')
+        if legacy_path:
+            self._import(legacy_path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _transaction(self):
+        """Connection in a write transaction, so check-then-insert is atomic across processes"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def _import(self, legacy_path):
+        """Move the rows of the JSON history file used by earlier versions into the table"""
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+        except (OSError, ValueError):
+            return
+        conn = self._transaction()
+        try:
+            with conn:
+                for row in rows:
+                    self._remember(conn, row['File Hash'], row)
+            os.remove(legacy_path)
+        except FileNotFoundError:
+            pass  # another worker imported it first
+        finally:
+            conn.close()
+
+    def _remember(self, conn, file_hash, row, keyed=True):
+        key = invoice_key(InvoiceRecord.from_dict(row)) if keyed else None
+        # REPLACE deletes the old row, so a refreshed file gets a new seq
+        conn.execute(
+            'INSERT OR REPLACE INTO dedup_history (file_hash, base_hash, invoice_key, row) VALUES (?, ?, ?, ?)',
+            (file_hash, split_part_hash(file_hash)[0], key, json.dumps(row))
+        )
+        excess = conn.execute('SELECT COUNT(*) FROM dedup_history').fetchone()[0] - self.max_entries
+        if excess > 0:
+            # A split file is only answered from history while all of its invoices are
+            conn.execute(
+                'DELETE FROM dedup_history WHERE base_hash IN '
+                '(SELECT base_hash FROM dedup_history ORDER BY seq LIMIT ?)',
+                (excess,)
+            )
+
+    def lookup(self, file_hash):
+        """Rows previously extracted from identical bytes (one per invoice of a split file), or []"""
+        if not self.enabled:
+            return []
+        conn = self._connect()
+        try:
+            found = conn.execute('SELECT row FROM dedup_history WHERE file_hash = ?', (file_hash,)).fetchone()
+            if found:
+                return [json.loads(found['row'])]
+            parts = conn.execute(
+                'SELECT file_hash, row FROM dedup_history WHERE base_hash = ? AND file_hash != base_hash',
+                (file_hash,)
+            ).fetchall()
+        finally:
+            conn.close()
+        parts.sort(key=lambda part: split_part_hash(part['file_hash'])[1])
+        return [json.loads(part['row']) for part in parts]
+
+    def known(self, hashes):
+        """The subset of file hashes that lookup would answer"""
+        if not self.enabled:
+            return set()
+        found = set()
+        conn = self._connect()
+        try:
+            for i in range(0, len(hashes), self.QUERY_CHUNK):
+                chunk = hashes[i:i + self.QUERY_CHUNK]
+                marks = ', '.join('?' for _ in chunk)
+                found.update(
+                    row[0] for row in conn.execute(
+                        f'SELECT file_hash FROM dedup_history WHERE file_hash IN ({marks}) '
+                        f'UNION SELECT base_hash FROM dedup_history WHERE base_hash IN ({marks})',
+                        chunk + chunk
+                    )
+                )
+        finally:
+            conn.close()
+        return found
+
+    def register(self, record):
+        """Add a freshly extracted record; returns the earlier row if it is a duplicate invoice
+        (or identical bytes another worker process registered since lookup missed).
+
+        A duplicate invoice is still recorded under its own file hash, without
+        the key and named after the earlier file, so re-uploading those bytes
+        is answered from history as a duplicate of that file instead of being
+        parsed again.
+        """
+        if not self.enabled or record.error:
+            return None
+        key = invoice_key(record)
+        conn = self._transaction()
+        try:
+            with conn:
+                earlier = conn.execute(
+                    'SELECT row FROM dedup_history WHERE file_hash = ? OR invoice_key = ? '
+                    'ORDER BY file_hash = ? DESC, seq DESC LIMIT 1',
+                    (record.file_hash, key, record.file_hash)
+                ).fetchone()
+                if earlier:
+                    earlier = json.loads(earlier['row'])
+                    if earlier['File Hash'] != record.file_hash:
+                        row = record.to_dict()
+                        row['File Name'] = earlier['File Name']
+                        self._remember(conn, record.file_hash, row, keyed=False)
+                    return earlier
+                self._remember(conn, record.file_hash, record.to_dict())
+        finally:
+            conn.close()
+        return None
+
+    def replace(self, record):
+        """Refresh the row of a re-extracted file that is still in the history"""
+        if not self.enabled:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'UPDATE dedup_history SET invoice_key = ?, row = ? WHERE file_hash = ?',
+                    (invoice_key(record), json.dumps(record.to_dict()), record.file_hash)
+                )
+        finally:
+            conn.close()
+
+dedup_index = DuplicateIndex(
+    app.config['RESULTS_DB'],
+    app.config['DEDUP_HISTORY_SIZE'],
+    enabled=app.config['DEDUP_MODE'] != 'off',
+    legacy_path=os.path.join(OUTPUT_FOLDER, 'dedup_index.json')
+)
+
+# ================================================================================
+# JOB JOURNAL (checkpointed partial results)
+# ================================================================================
+
+JOB_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+class JobJournal:
+    """Append-only JSONL journal of the rows produced by one job.
+
+    Every record is written and fsynced as soon as it is extracted, so a job
+    that fails later (e.g. while writing the workbook) can be retried with the
+    same job id: files journaled without an error are skipped, the others are
+    extracted again (their new rows replace the failed ones) and the workbook
+    is assembled from the journal.
+    """
+
+    def __init__(self, job_id, folder=None):
+        self.job_id = job_id
+        self.path = os.path.join(folder or app.config['JOBS_FOLDER'], f'{job_id}.jsonl')
+        self.lock = threading.Lock()
+
+    def rows(self):
+        """All journaled rows; a torn last line from a crash is ignored"""
+        rows = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return rows
+
+    def completed_hashes(self):
+        """Hashes of the files journaled so far (a split file by its own hash).
+
+        Files with an error row (in any of their invoices) are left out, so a
+        retry of the job extracts them again.
+        """
+        done, failed = set(), set()
+        for row in self.current_rows():
+            if row.get('File Hash'):
+                (failed if row.get('Error') else done).add(split_part_hash(row['File Hash'])[0])
+        return done - failed
+
+    def current_rows(self):
+        """Journaled rows without the failed attempts a retry has replaced.
+
+        A retried upload journals its rows again under the same file name and
+        hash (its own hash, or that of one of its split invoices, repeats). An
+        earlier attempt with an error row is dropped once a later attempt of
+        the same upload exists; copies of the same bytes uploaded under other
+        names, and attempts that succeeded, are always kept.
+        """
+        rows = self.rows()
+        attempts = {}  # (upload name, file hash) -> (attempt number, hashes seen in it, split)
+        failed = set()  # (upload, attempt number) of attempts with an error row
+        row_attempts = []
+        for row in rows:
+            if not row.get('File Hash'):
+                row_attempts.append(None)
+                continue
+            base, pages = split_part_hash(row['File Hash'])
+            upload = (upload_file_name(row.get('File Name') or '', pages), base)
+            number, seen, split = attempts.get(upload, (0, set(), pages is not None))
+            if row['File Hash'] in seen or split != (pages is not None):
+                number, seen, split = number + 1, set(), pages is not None
+            seen.add(row['File Hash'])
+            attempts[upload] = (number, seen, split)
+            if row.get('Error'):
+                failed.add((upload, number))
+            row_attempts.append((upload, number))
+        return [
+            row for row, attempt in zip(rows, row_attempts)
+            if attempt is None or attempt not in failed or attempts[attempt[0]][0] == attempt[1]
+        ]
+
+    def append(self, record):
+        line = json.dumps(record.to_dict()) + '\n'
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def batch(self, skip_duplicates=False):
+        """InvoiceBatch of the journaled rows"""
+        batch = InvoiceBatch()
+        for row in self.current_rows():
+            if skip_duplicates and row.get('Duplicate Of'):
+                continue
+            batch.append(InvoiceRecord.from_dict(row))
+        return batch
+
+def resolve_job_id(job_id):
+    """Validate a client-supplied job id or create a new one"""
+    if job_id and JOB_ID_PATTERN.match(job_id):
+        return job_id
+    return uuid.uuid4().hex
+
+def track_progress(job_id, total):
+    """Start progress reporting for a job; returns the dict to update"""
+    global progress_data
+    progress = {'current': 0, 'total': total, 'status': 'processing', 'message': 'Starting...'}
+    with progress_lock:
+        job_progress[job_id] = progress
+        job_progress.move_to_end(job_id)
+        while len(job_progress) > PROGRESS_HISTORY:
+            job_progress.popitem(last=False)
+        progress_data = progress
+    return progress
+
+# ================================================================================
+# RESULT STORE (SQLite history of every extraction)
+# ================================================================================
+
+class ResultStore:
+    """SQLite store of every extracted row, indexed for reporting queries.
+
+    Columns mirror InvoiceRecord slots; money stays in integer paise and the
+    parsed invoice date is stored as ISO text so ranges and months sort.
+    """
+
+    COLUMNS = ('job_id', 'created_at') + InvoiceRecord.__slots__
+    # Slots rewritten when a file is re-extracted; name, hash and duplicate flag stay
+    EXTRACTED_SLOTS = tuple(
+        slot for slot in InvoiceRecord.__slots__ if slot not in ('file_name', 'file_hash', 'duplicate_of')
+    )
+    INDEXES = {
+        'idx_invoices_airline_date': ('airline', 'date'),
+        'idx_invoices_date': ('date',),
+        'idx_invoices_gstin': ('gstin',),
+        'idx_invoices_customer_gstin': ('customer_gstin',),
+        'idx_invoices_pnr': ('pnr',),
+        'idx_invoices_file_hash': ('file_hash',),
+    }
+    # Query string filter -> (SQL condition, value transform)
+    FILTERS = {
+        'airline': ('airline LIKE ?', lambda v: v.upper() + '%'),
+        'gstin': ('gstin = ?', str.upper),
+        'customer_gstin': ('customer_gstin = ?', str.upper),
+        'pnr': ('pnr = ?', str.upper),
+        'number': ('number = ?', str),
+        'job_id': ('job_id = ?', str),
+        'date_from': ('date >= ?', str),
+        'date_to': ('date <= ?', str),
+    }
+    GROUPS = {
+        'airline': 'airline',
+        'gstin': 'gstin',
+        'customer_gstin': 'customer_gstin',
+        'date': 'date',
+        'month': "substr(date, 1, 7)",
+    }
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS invoices (id INTEGER PRIMARY KEY, '
+                + ', '.join(
+                    f'{col} INTEGER' if col in InvoiceRecord.MONEY_SLOTS
+                    else f'{col} TEXT COLLATE NOCASE' if col == 'airline'
+                    else f'{col} TEXT'
+                    for col in self.COLUMNS
+                )
+                + ')'
+            )
+            # Columns of slots added since the table was created (e.g. derived)
+            existing = {row['name'] for row in conn.execute('PRAGMA table_info(invoices)')}
+            for col in self.COLUMNS:
+                if col not in existing:
+                    conn.execute(f'ALTER TABLE invoices ADD COLUMN {col} TEXT')
+            for name, cols in self.INDEXES.items():
+                conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON invoices ({", ".join(cols)})')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def slot_values(record):
+        """Slot -> stored value of a record (the date as ISO text)"""
+        values = {}
+        for slot in InvoiceRecord.__slots__:
+            value = getattr(record, slot)
+            values[slot] = value.isoformat() if slot == 'date' and value else value
+        return values
+
+    def _values(self, record, job_id):
+        values = {'job_id': job_id, 'created_at': datetime.now().isoformat(timespec='seconds')}
+        values.update(self.slot_values(record))
+        return [values[col] for col in self.COLUMNS]
+
+    def add(self, record, job_id=None):
+        placeholders = ', '.join('?' for _ in self.COLUMNS)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f'INSERT INTO invoices ({", ".join(self.COLUMNS)}) VALUES ({placeholders})',
+                self._values(record, job_id)
+            )
+
+    def history(self, airline=None):
+        """Latest stored row of every distinct file, optionally of one airline, as InvoiceRecords"""
+        condition, params = 'file_hash IS NOT NULL', []
+        if airline:
+            condition += ' AND airline LIKE ?'
+            params.append(airline.upper() + '%')
+        sql = (f'SELECT * FROM invoices WHERE id IN '
+               f'(SELECT MAX(id) FROM invoices WHERE {condition} GROUP BY file_hash) ORDER BY id')
+        with closing(self._connect()) as conn, conn:
+            return [
+                InvoiceRecord(**{slot: row[slot] for slot in InvoiceRecord.__slots__})
+                for row in conn.execute(sql, params)
+            ]
+
+    def update_extractions(self, records):
+        """Overwrite the extracted fields of all rows of each record's file in one transaction"""
+        assignments = ', '.join(f'{slot} = ?' for slot in self.EXTRACTED_SLOTS)
+        rows = []
+        for record in records:
+            values = self.slot_values(record)
+            rows.append([values[slot] for slot in self.EXTRACTED_SLOTS] + [record.file_hash])
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(f'UPDATE invoices SET {assignments} WHERE file_hash = ?', rows)
+        finally:
+            conn.close()
+
+    def query(self, filters, group_by=None, include_duplicates=False, limit=100, offset=0):
+        """Filtered rows, or per-group sums when group_by is given (amounts in rupees)"""
+        conditions, params = ['error IS NULL'], []
+        if not include_duplicates:
+            conditions.append('duplicate_of IS NULL')
+        for name, value in filters.items():
+            if name in self.FILTERS and value:
+                condition, transform = self.FILTERS[name]
+                conditions.append(condition)
+                params.append(transform(value))
+        where = ' AND '.join(conditions)
+        sums = ', '.join(
+            f'SUM({col}) / 100.0 AS {col.replace("_paise", "")}' for col in InvoiceRecord.MONEY_SLOTS
+        )
+
+        with closing(self._connect()) as conn, conn:
+            if group_by:
+                group = self.GROUPS[group_by]
+                sql = (f'SELECT {group} AS {group_by}, COUNT(*) AS invoices, {sums} FROM invoices '
+                       f'WHERE {where} GROUP BY {group} ORDER BY {group}')
+                return [dict(row) for row in conn.execute(sql, params)]
+            sql = (f'SELECT * FROM invoices WHERE {where} '
+                   f'ORDER BY date DESC, id DESC LIMIT ? OFFSET ?')
+            rows = []
+            for row in conn.execute(sql, params + [limit, offset]):
+                row = dict(row)
+                for col in InvoiceRecord.MONEY_SLOTS:
+                    paise = row.pop(col)
+                    row[col.replace('_paise', '')] = paise / 100 if paise is not None else None
+                rows.append(row)
+            return rows
+
+result_store = ResultStore(app.config['RESULTS_DB'])
+
+# ================================================================================
+# REPLAY (re-run the current rules over stored history)
+# ================================================================================
+
+REPLAY_IGNORED_COLUMNS = ('File Name', 'File Hash', 'Duplicate Of')
+
+def _replay_worker(item):
+    file_hash, file_name = item
+    base, pages = split_part_hash(file_hash)
+    source = PageRange(CachedPDF(base), *pages) if pages else CachedPDF(base)
+    try:
+        record = extract_record(source, file_name)
+    except ParseCacheMiss:
+        return file_hash, None
+    record.file_hash = file_hash
+    return file_hash, record
+
+def field_diffs(old, new):
+    """{column: (old, new)} of the workbook fields that differ between two records"""
+    old_row, new_row = old.to_dict(), new.to_dict()
+    return {
+        column: (old_row[column], new_row[column])
+        for column in old_row
+        if column not in REPLAY_IGNORED_COLUMNS and old_row[column] != new_row[column]
+    }
+
+def replay_history(airline=None, workers=None, dry_run=False):
+    """Re-extract every stored file from the parse cache with the current rules.
+
+    Files run in parallel on a process pool; nothing touches the PDFs, so files
+    whose content is not cached are only counted. Changed rows are written to
+    the result store in one transaction (and refreshed in the duplicate index)
+    unless dry_run. Returns a report with the field-level diffs per file hash.
+    """
+    stored = {record.file_hash: record for record in result_store.history(airline)}
+    report = {'files': len(stored), 'replayed': 0, 'changed': 0, 'not_cached': 0, 'diffs': {}}
+    changed = []
+    
+    items = [(file_hash, record.file_name) for file_hash, record in stored.items()]
+    with extraction_context().Pool(workers or os.cpu_count()) as pool:
+        for file_hash, record in pool.imap_unordered(_replay_worker, items, chunksize=8):
+            if record is None:
+                report['not_cached'] += 1
+                continue
+            report['replayed'] += 1
+            diffs = field_diffs(stored[file_hash], record)
+            if diffs:
+                report['diffs'][file_hash] = (stored[file_hash].file_name, diffs)
+                changed.append(record)
+    
+    report['changed'] = len(changed)
+    if changed and not dry_run:
+        result_store.update_extractions(changed)
+        for record in changed:
+            dedup_index.replace(record)
+    return report
+
+# ================================================================================
+# WORKBOOK OUTPUT
+# ================================================================================
+
+WORKBOOK_COLUMNS = ['File Name', 'GSTIN', 'GSTIN of Customer', 'Number', 'GSTIN Customer Name', 
+                    'Date', 'PNR', 'From', 'To', 'Ticket Number', 'Taxable Value', 'CGST', 'SGST', 'IGST', 
+                    'Total(Incl Taxes)', 'Tax Summary', 'Validation', 'Duplicate Of']
+
+def write_workbook(batch):
+    """Validate a batch and write it to a new workbook; returns (path, filename)"""
+    df = batch.to_dataframe()
+    
+    for col in WORKBOOK_COLUMNS:
+        if col not in df.columns:
+            df[col] = ''
+    
+    df = validate_batch(df)
+    df = df[WORKBOOK_COLUMNS]
+    
+    # Save to Excel
+    # The random suffix keeps concurrent requests in the same second apart
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_filename = f'airline_invoices_{timestamp}_{uuid.uuid4().hex[:8]}.xlsx'
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    
+    df.to_excel(output_path, index=False, engine='openpyxl')
+    return output_path, output_filename
+
+# ================================================================================
+# RETENTION (background cleanup of outputs/, jobs/, the parse cache and uploads/)
+# ================================================================================
+
+def entry_usage(path):
+    """(bytes, newest mtime) of a file or of everything below a directory"""
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+    size, newest = 0, os.stat(path).st_mtime
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            size += st.st_size
+            newest = max(newest, st.st_mtime)
+    return size, newest
+
+class ScratchDir:
+    """Upload directory of one running request, marked in use until remove()
+
+    The request holds an exclusive lock on the IN_USE file inside it, so the
+    janitor's orphan sweep leaves it alone however long the request (or a
+    streamed response) runs; a crashed request drops the lock with its process.
+    """
+
+    IN_USE = '.in-use'
+
+    def __init__(self, prefix, folder):
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=folder)
+        self._lock_file = open(os.path.join(self.path, self.IN_USE), 'w')
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._lock_file.close()
+
+def upload_in_use(path):
+    """True while a running request holds the ScratchDir lock of an uploads entry"""
+    marker = os.path.join(path, ScratchDir.IN_USE)
+    if fcntl is None or not os.path.isfile(marker):
+        return False
+    try:
+        with open(marker) as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return False
+
+class RetentionJanitor:
+    """Keeps outputs, job journals, the parse cache and uploads within age and size quotas.
+
+    Workbooks past the age quota are removed, then the oldest ones (by mtime)
+    until the folder fits the size quota. Job journals and settings are
+    handled the same way per job, their newest mtime counting. Parse cache
+    entries are touched on every hit, so there the oldest mtime is the least
+    recently used entry. Upload entries untouched for longer than the orphan
+    age were left behind by crashed or aborted requests; scratch directories
+    of running requests and spool directories of unfinished jobs are kept.
+    Files younger than MIN_AGE are never touched so a response that is still
+    being sent keeps its workbook. Of several processes (gunicorn workers)
+    only the one holding lock_path sweeps.
+    """
+
+    MIN_AGE = 60  # seconds
+    OUTPUT_SUFFIX = '.xlsx'
+    JOB_SUFFIXES = ('.jsonl', '.json')
+
+    def __init__(self, output_folder, upload_folder, max_age=0, max_bytes=0, orphan_age=0,
+                 jobs_folder=None, job_max_age=0, job_max_bytes=0,
+                 cache_folder=None, cache_max_age=0, cache_max_bytes=0, lock_path=None):
+        self.output_folder = output_folder
+        self.upload_folder = upload_folder
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.orphan_age = orphan_age
+        self.jobs_folder = jobs_folder
+        self.job_max_age = job_max_age
+        self.job_max_bytes = job_max_bytes
+        self.cache_folder = cache_folder
+        self.cache_max_age = cache_max_age
+        self.cache_max_bytes = cache_max_bytes
+        self.lock_path = lock_path
+        self._lock = threading.Lock()
+        self._thread = None
+        self._leader_file = None
+        self.stats = {
+            'leader': False, 'runs': 0, 'last_run': None, 'errors': 0,
+            'outputs_removed': 0, 'jobs_removed': 0, 'cache_removed': 0, 'uploads_removed': 0, 'bytes_freed': 0,
+            'output_files': 0, 'output_bytes': 0, 'jobs': 0, 'job_bytes': 0,
+            'cache_files': 0, 'cache_bytes': 0, 'upload_entries': 0,
+        }
+
+    def _remove(self, path):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            self.stats['errors'] += 1
+            print(f"Retention could not remove {path}: {e}")
+            return False
+
+    def _entries(self, folder):
+        """(mtime, bytes, [path]) of every file or directory in folder"""
+        entries = []
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                size, mtime = entry_usage(path)
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, size, [path]))
+        return entries
+
+    def _job_entries(self):
+        """(newest mtime, bytes, [paths]) per job: its journal and settings go together"""
+        jobs = {}
+        for mtime, size, paths in self._entries(self.jobs_folder):
+            job_id, _, suffix = os.path.basename(paths[0]).partition('.')
+            if '.' + suffix not in self.JOB_SUFFIXES:
+                continue
+            newest, total, job_paths = jobs.get(job_id, (0, 0, []))
+            jobs[job_id] = (max(newest, mtime), total + size, job_paths + paths)
+        return list(jobs.values())
+
+    def _cache_entries(self):
+        """(mtime, bytes, [path]) of every parse cache file below its hash-prefix directories"""
+        entries = []
+        for root, dirs, names in os.walk(self.cache_folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, [path]))
+        return entries
+
+    def _expire(self, entries, max_age, max_bytes, now, counter):
+        """Remove entries past max_age, then the oldest until they fit max_bytes; returns (entries, bytes) left"""
+        entries = sorted(entries, key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for mtime, size, paths in entries:
+            if now - mtime < self.MIN_AGE:
+                break
+            expired = max_age and now - mtime > max_age
+            over_quota = max_bytes and total > max_bytes
+            if (expired or over_quota) and all([self._remove(path) for path in paths]):
+                total -= size
+                count -= 1
+                self.stats[counter] += 1
+                self.stats['bytes_freed'] += size
+        return count, total
+
+    def _in_progress(self, path):
+        """Scratch directory of a running request, or spool directory of a job not yet finished"""
+        if upload_in_use(path):
+            return True
+        name = os.path.basename(path)
+        if self.jobs_folder and name.startswith('job-'):
+            return os.path.exists(os.path.join(self.jobs_folder, f'{name[4:]}.json'))
+        return False
+
+    def _lead(self):
+        """Take (or keep) the sweeper lock shared by all processes of this deployment"""
+        if self._leader_file is not None or self.lock_path is None or fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._leader_file = lock_file
+        self.stats['leader'] = True
+        return True
+
+    def sweep(self, now=None):
+        """Apply the quotas once; returns a copy of the updated stats"""
+        now = now or time.time()
+        with self._lock:
+            outputs = [entry for entry in self._entries(self.output_folder)
+                       if entry[2][0].endswith(self.OUTPUT_SUFFIX)]
+            files, total = self._expire(outputs, self.max_age, self.max_bytes, now, 'outputs_removed')
+            jobs = job_bytes = cache_files = cache_bytes = 0
+            if self.jobs_folder:
+                jobs, job_bytes = self._expire(self._job_entries(), self.job_max_age, self.job_max_bytes,
+                                               now, 'jobs_removed')
+            if self.cache_folder:
+                cache_files, cache_bytes = self._expire(self._cache_entries(), self.cache_max_age,
+                                                        self.cache_max_bytes, now, 'cache_removed')
+            
+            remaining = 0
+            for mtime, size, (path,) in self._entries(self.upload_folder):
+                age = now - mtime
+                if (self.orphan_age and age > max(self.orphan_age, self.MIN_AGE)
+                        and not self._in_progress(path) and self._remove(path)):
+                    self.stats['uploads_removed'] += 1
+                    self.stats['bytes_freed'] += size
+                else:
+                    remaining += 1
+            
+            self.stats.update({
+                'runs': self.stats['runs'] + 1,
+                'last_run': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                'output_files': files,
+                'output_bytes': total,
+                'jobs': jobs,
+                'job_bytes': job_bytes,
+                'cache_files': cache_files,
+                'cache_bytes': cache_bytes,
+                'upload_entries': remaining,
+            })
+            return dict(self.stats)
+
+    def start(self, interval):
+        """Sweep every interval seconds on a daemon thread, whenever this process holds the lock"""
+        if self._thread is not None or interval <= 0:
+            return
+        
+        def loop():
+            while True:
+                try:
+                    if self._lead():
+                        self.sweep()
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    print(f"Retention sweep failed: {e}")
+                time.sleep(interval)
+        
+        self._thread = threading.Thread(target=loop, name='retention-janitor', daemon=True)
+        self._thread.start()
+
+janitor = RetentionJanitor(
+    app.config['OUTPUT_FOLDER'],
+    app.config['UPLOAD_FOLDER'],
+    max_age=app.config['OUTPUT_MAX_AGE_HOURS'] * 3600,
+    max_bytes=app.config['OUTPUT_MAX_MB'] * 1024 * 1024,
+    orphan_age=app.config['UPLOAD_ORPHAN_MINUTES'] * 60,
+    jobs_folder=app.config['JOBS_FOLDER'],
+    job_max_age=app.config['JOBS_MAX_AGE_DAYS'] * 86400,
+    job_max_bytes=app.config['JOBS_MAX_MB'] * 1024 * 1024,
+    cache_folder=app.config['PARSE_CACHE_FOLDER'],
+    cache_max_age=app.config['PARSE_CACHE_MAX_AGE_DAYS'] * 86400,
+    cache_max_bytes=app.config['PARSE_CACHE_MAX_MB'] * 1024 * 1024,
+    lock_path=os.path.join(DATA_FOLDER, 'janitor.lock'),
+)
+
+def start_janitor():
+    """Start the sweeps in a serving process (gunicorn.conf.py, asgi.py, app.run), not on import"""
+    janitor.start(app.config['JANITOR_INTERVAL'])
+
+# ================================================================================
+# ARCHIVE INGESTION (ZIP / tar.gz uploads)
+# ================================================================================
+
+def iter_archive_pdfs(fileobj, archive_name):
+    """Yield (name, bytes, error) for each PDF member of a ZIP or tar archive.
+
+    Members are read into memory one at a time and never written to disk.
+    Oversized or corrupt members yield an error message instead of bytes.
+    """
+    max_bytes = app.config['ARCHIVE_MEMBER_MAX_MB'] * 1024 * 1024
+    too_large = f"larger than {app.config['ARCHIVE_MEMBER_MAX_MB']}MB"
+    
+    if archive_name.lower().endswith('.zip'):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                name = secure_filename(os.path.basename(info.filename))
+                if info.is_dir() or not name.lower().endswith('.pdf'):
+                    continue
+                if info.file_size > max_bytes:
+                    yield name, None, f'Archive member {too_large}'
+                    continue
+                try:
+                    with archive.open(info) as member:
+                        data = member.read(max_bytes + 1)
+                except (zipfile.BadZipFile, RuntimeError, OSError) as e:
+                    yield name, None, f'Unreadable archive member: {e}'
+                    continue
+                if len(data) > max_bytes:
+                    yield name, None, f'Archive member {too_large}'
+                    continue
+                yield name, data, None
+        return
+    
+    # Stream mode reads tar members in order without seeking
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for info in archive:
+            name = secure_filename(os.path.basename(info.name))
+            if not info.isfile() or not name.lower().endswith('.pdf'):
+                continue
+            if info.size > max_bytes:
+                yield name, None, f'Archive member {too_large}'
+                continue
+            yield name, archive.extractfile(info).read(), None
+
+# ================================================================================
+# UPLOAD PROCESSING
+# ================================================================================
+
+def process_file(source, filename, airline, job_id, journal, done_hashes, deadline=None):
+    """Extract, dedup and journal one upload: a saved path (deleted afterwards) or raw bytes.
+
+    With a deadline (time.monotonic()) the extraction gets at most the time
+    left, and past it the file is journaled as an error row so a retry of
+    the job picks it up. Returns the journaled records ([] if the job
+    already has the file).
+    """
+    try:
+        if isinstance(source, bytes):
+            file_hash = hashlib.sha256(source).hexdigest()
+        else:
+            file_hash = file_sha256(source)
+        if file_hash in done_hashes:
+            return []
+        
+        timeout = None
+        if deadline is not None:
+            timeout = min(app.config['EXTRACTION_TIMEOUT'], deadline - time.monotonic())
+            if timeout <= 0:
+                record = InvoiceRecord(file_name=filename, airline='ERROR', file_hash=file_hash,
+                                       error='Request deadline reached; repeat the request with its job_id')
+                return journal_records([(record, None)], job_id, journal)
+        return journal_records(new_or_known_records(source, file_hash, filename, airline, timeout),
+                               job_id, journal)
+    finally:
+        if not isinstance(source, bytes):
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+
+# Hashes of files being extracted right now, so identical uploads running at the
+# same time (stream threads, spool workers) are parsed once and flagged as usual
+extractions_in_flight = {}
+in_flight_lock = threading.Lock()
+
+def new_or_known_records(source, file_hash, filename, airline, timeout=None):
+    """(record, earlier row or None) pairs of one upload.
+
+    Identical bytes are answered from the index without parsing. If another
+    thread is extracting the same bytes, this waits for it and then answers
+    from the history it registered; only if that attempt failed is the file
+    extracted again here.
+    """
+    while True:
+        results = history_records(file_hash, filename)
+        if results:
+            return results
+        with in_flight_lock:
+            running = extractions_in_flight.get(file_hash)
+            if running is None:
+                extractions_in_flight[file_hash] = threading.Event()
+        if running is None:
+            break
+        running.wait()
+    
+    try:
+        extracted = extract_records_isolated(source, filename, airline, timeout)
+        # A file with a failed invoice stays out of the history, so a retry extracts all of it
+        failed = any(record.error for _, record in extracted)
+        for pages, record in extracted:
+            record.file_hash = part_hash(file_hash, pages)
+            results.append((record, None if failed else dedup_index.register(record)))
+        return results
+    finally:
+        with in_flight_lock:
+            extractions_in_flight.pop(file_hash).set()
+
+def history_records(file_hash, filename):
+    """(record, earlier row) pairs of identical bytes extracted before, or []"""
+    results = []
+    for row in dedup_index.lookup(file_hash):
+        record = InvoiceRecord.from_dict(row)
+        record.file_name = part_file_name(filename, split_part_hash(row['File Hash'])[1])
+        results.append((record, row))
+    return results
+
+def journal_records(results, job_id, journal):
+    """Journal and store (record, duplicate row or None) pairs; returns the records"""
+    for record, duplicate in results:
+        if duplicate is not None:
+            record.duplicate_of = duplicate['File Name']
+        journal.append(record)
+        result_store.add(record, job_id)
+    return [record for record, _ in results]
+
+def parse_known(form):
+    """(file hash, file name) pairs a client sent instead of files the server already has.
+
+    The page asks /known which of its files are in the duplicate history and
+    sends those in a single `known` field, a JSON list of [hash, name] pairs,
+    rather than as bytes (one field, so form part limits do not apply).
+    Returns None if the field is malformed.
+    """
+    try:
+        pairs = json.loads(form.get('known') or '[]')
+    except ValueError:
+        return None
+    if not isinstance(pairs, list) or not all(
+        isinstance(pair, list) and len(pair) == 2 and isinstance(pair[0], str) and isinstance(pair[1], str)
+        and FILE_HASH_PATTERN.match(pair[0]) for pair in pairs
+    ):
+        return None
+    return [(file_hash, secure_filename(name) or f'{file_hash[:12]}.pdf') for file_hash, name in pairs]
+
+def known_error(known):
+    """(JSON body, status) rejecting the known pairs of a request, or None if they can be used"""
+    if known is None:
+        return {'error': 'known must be a JSON list of [SHA-256 digest, file name] pairs'}, 400
+    if len(known) > MAX_KNOWN_FILES:
+        return {'error': f'At most {MAX_KNOWN_FILES} known files per request; send them in parts'}, 413
+    # Files that left the history since the client asked /known: it uploads them and repeats the request
+    found = dedup_index.known([file_hash for file_hash, _ in known])
+    unknown = [file_hash for file_hash, _ in known if file_hash not in found]
+    if unknown:
+        return {'error': 'Some files are no longer known; upload them', 'unknown': unknown}, 409
+    return None
+
+def process_known(known, job_id, journal, done_hashes, progress):
+    """Journal the history rows of files sent by hash only; returns the records per pair"""
+    processed = []
+    for file_hash, filename in known:
+        progress['current'] += 1
+        progress['message'] = f'Taking {filename} from history'
+        if file_hash in done_hashes:
+            processed.append([])
+            continue
+        # Rows sent by hash are this file's own results, not duplicates of another upload.
+        # The result store already holds them from the upload that extracted them, so
+        # they go to the job journal only (storing them again would count them twice)
+        records = [record for record, _ in history_records(file_hash, filename)] or [
+            InvoiceRecord(file_name=filename, airline='ERROR',
+                          error='No longer in the duplicate history; upload the file again')
+        ]
+        for record in records:
+            journal.append(record)
+        processed.append(records)
+    return processed
+
+def process_archive(fileobj, archive_name, airline, job_id, journal, done_hashes, progress, emit=None,
+                    deadline=None):
+    """Process the PDF members of a ZIP/tar archive one at a time, straight from the stream.
+
+    The archive counts as one file in progress['total'] until its members are
+    seen. emit(name, records), if given, is called as each member is done;
+    deadline is passed on to process_file.
+    """
+    progress['total'] -= 1
+    try:
+        for name, data, error in iter_archive_pdfs(fileobj, archive_name):
+            progress['total'] += 1
+            progress['current'] += 1
+            progress['message'] = f'Processing {archive_name}: {name}'
+            if error:
+                record = InvoiceRecord(file_name=name, airline='ERROR', error=error)
+                journal.append(record)
+                result_store.add(record, job_id)
+                records = [record]
+            else:
+                records = process_file(data, name, airline, job_id, journal, done_hashes, deadline)
+            if emit:
+                emit(name, records)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        progress['total'] += 1
+        progress['current'] += 1
+        record = InvoiceRecord(file_name=archive_name, airline='ERROR', error=f'Unreadable archive: {e}')
+        journal.append(record)
+        result_store.add(record, job_id)
+        if emit:
+            emit(archive_name, [record])
+
+def process_uploads(files, airline, job_id, journal, done_hashes, progress, scratch_dir):
+    """Extract, dedup and journal each uploaded file of a /process request within REQUEST_DEADLINE"""
+    deadline = None
+    if app.config['REQUEST_DEADLINE']:
+        deadline = time.monotonic() + app.config['REQUEST_DEADLINE']
+    for idx, file in enumerate(files):
+        if file and allowed_file(file.filename):
+            filename = secure_filename(file.filename)
+            if is_archive(filename):
+                process_archive(file.stream, filename, airline, job_id, journal, done_hashes, progress,
+                                deadline=deadline)
+                continue
+            
+            progress['current'] += 1
+            progress['message'] = f'Processing {file.filename}'
+            filepath = os.path.join(scratch_dir, f'{idx:03d}_{filename}')
+            file.save(filepath)
+            process_file(filepath, filename, airline, job_id, journal, done_hashes, deadline)
+
+# ================================================================================
+# STREAMED RESULTS (/process?stream=ndjson)
+# ================================================================================
+
+def save_uploads(files, scratch_dir):
+    """Save a request's uploads for stream_records: [(index, filename, path or None if not accepted)]"""
+    saved = []
+    for idx, file in enumerate(files):
+        filename = secure_filename(file.filename or '')
+        path = None
+        if filename and allowed_file(filename):
+            path = os.path.join(scratch_dir, f'{idx:03d}_{filename}')
+            file.save(path)
+        saved.append((idx, filename or file.filename, path))
+    return saved
+
+def stream_records(saved, airline, job_id, journal, done_hashes, progress, known=()):
+    """NDJSON lines of a batch: one per file as soon as it is extracted, in completion order.
+
+    Each line is {"index", "file_name", "rows"[, "error"]} with the file's
+    position in the upload; every PDF member of an archive gets its own line
+    under the archive's index. Files run on EXTRACTION_WORKERS threads and
+    rows are journaled as in /process, so GET /jobs/<job_id>/workbook still
+    builds the workbook. Files sent by hash only (parse_known) come first,
+    as {"hash", "file_name", "rows"}. The last line is
+    {"done": true, "job_id", "files", "rows"}.
+    """
+    files = rows = finished = 0
+    for (file_hash, filename), records in zip(known, process_known(known, job_id, journal, done_hashes, progress)):
+        files += 1
+        rows += len(records)
+        yield json.dumps({'hash': file_hash, 'file_name': filename,
+                          'rows': [record.to_dict() for record in records]}) + '\n'
+    
+    lines = queue.Queue()
+    
+    def emit(index, filename, records, error=None):
+        line = {'index': index, 'file_name': filename, 'rows': [record.to_dict() for record in records]}
+        if error:
+            line['error'] = error
+        lines.put((len(records), json.dumps(line) + '\n'))
+    
+    def run(index, filename, path):
+        try:
+            if path is None:
+                emit(index, filename, [], 'Not a PDF or archive')
+            elif is_archive(filename):
+                with open(path, 'rb') as f:
+                    process_archive(f, filename, airline, job_id, journal, done_hashes, progress,
+                                    emit=lambda name, records: emit(index, name, records))
+            else:
+                progress['current'] += 1
+                progress['message'] = f'Processing {filename}'
+                emit(index, filename, process_file(path, filename, airline, job_id, journal, done_hashes))
+        except Exception as e:
+            record = InvoiceRecord(file_name=filename, airline='ERROR', error=str(e))
+            journal.append(record)
+            emit(index, filename, [record])
+        finally:
+            lines.put(None)
+    
+    with ThreadPoolExecutor(max_workers=app.config['EXTRACTION_WORKERS'], thread_name_prefix='stream') as pool:
+        for upload in saved:
+            pool.submit(run, *upload)
+        while finished < len(saved):
+            item = lines.get()
+            if item is None:
+                finished += 1
+                continue
+            files += 1
+            rows += item[0]
+            yield item[1]
+    
+    progress['status'] = 'complete'
+    progress['message'] = 'Processing complete!'
+    yield json.dumps({'done': True, 'job_id': job_id, 'files': files, 'rows': rows}) + '\n'
+
+# ================================================================================
+# CHUNKED UPLOADS (create job -> upload parts -> finalize)
+# ================================================================================
+
+CLAIM_SUFFIX = '.working'
+
+def job_spool_dir(job_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f'job-{job_id}')
+
+def job_meta_path(job_id):
+    return os.path.join(app.config['JOBS_FOLDER'], f'{job_id}.json')
+
+def load_job(job_id):
+    """Settings of a chunked upload job, or None if it was never created"""
+    try:
+        with open(job_meta_path(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def spool_entries(job_id):
+    """(waiting, claimed) file names in the spool directory of a job"""
+    try:
+        names = os.listdir(job_spool_dir(job_id))
+    except FileNotFoundError:
+        return [], []
+    claimed = [name for name in names if name.endswith(CLAIM_SUFFIX)]
+    waiting = [name for name in names if not name.endswith(CLAIM_SUFFIX)]
+    return waiting, claimed
+
+def reclaim_stale(job_id):
+    """Put claims nobody is working on back in the queue.
+
+    A claim is touched when it is taken and as archive members finish, so
+    one untouched for CLAIM_STALE_AFTER seconds belongs to a worker that was
+    killed mid-file; renaming it back lets the next pass extract it again.
+    """
+    spool_dir = job_spool_dir(job_id)
+    cutoff = time.time() - app.config['CLAIM_STALE_AFTER']
+    for name in spool_entries(job_id)[1]:
+        path = os.path.join(spool_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.rename(path, path[:-len(CLAIM_SUFFIX)])
+                print(f"Reclaimed stale spool file {name} of job {job_id}")
+        except FileNotFoundError:
+            pass  # finished or reclaimed meanwhile
+
+def process_spooled(job_id, name, airline, journal, done_hashes, progress):
+    """Claim one spooled file by renaming it and process it.
+
+    The rename is atomic, so a file is extracted exactly once even when the
+    worker thread and a finalize request (possibly in another process) race
+    for it. Returns False if someone else claimed it first.
+    """
+    path = os.path.join(job_spool_dir(job_id), name)
+    claimed = path + CLAIM_SUFFIX
+    try:
+        os.rename(path, claimed)
+        os.utime(claimed)  # the claim's age is what reclaim_stale looks at
+    except FileNotFoundError:
+        return False
+    filename = name.split('_', 1)[1]
+    if is_archive(filename):
+        try:
+            with open(claimed, 'rb') as f:
+                process_archive(f, filename, airline, job_id, journal, done_hashes, progress,
+                                emit=lambda name, records: os.utime(claimed))
+        finally:
+            os.remove(claimed)
+        return True
+    
+    progress['message'] = f'Processing {filename}'
+    try:
+        process_file(claimed, filename, airline, job_id, journal, done_hashes)
+    finally:
+        progress['current'] += 1
+    return True
+
+class SpoolWorker:
+    """Background extraction of the parts of one chunked upload job.
+
+    Files are queued as each part arrives, so extraction overlaps with the
+    rest of the upload. A None item stops the thread once the queue is empty.
+    """
+
+    def __init__(self, job_id, airline):
+        self.job_id = job_id
+        self.airline = airline
+        self.journal = JobJournal(job_id)
+        self.done_hashes = self.journal.completed_hashes()
+        self.progress = job_progress.get(job_id) or track_progress(job_id, 0)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f'spool-{job_id}', daemon=True)
+        self.thread.start()
+
+    def submit(self, name):
+        self.queue.put(name)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def _run(self):
+        while True:
+            name = self.queue.get()
+            if name is None:
+                return
+            try:
+                process_spooled(self.job_id, name, self.airline, self.journal, self.done_hashes, self.progress)
+            except Exception as e:
+                print(f"Spooled file {name} of job {self.job_id} failed: {e}")
+
+spool_workers = {}
+spool_lock = threading.Lock()
+
+def spool_worker(job_id, airline):
+    with spool_lock:
+        worker = spool_workers.get(job_id)
+        if worker is None:
+            worker = spool_workers[job_id] = SpoolWorker(job_id, airline)
+        return worker
+
+def release_spool_worker(job_id):
+    with spool_lock:
+        worker = spool_workers.pop(job_id, None)
+    if worker is not None:
+        worker.stop()
+
+# ================================================================================
+# FLASK ROUTES
+# ================================================================================
+
+@app.route('/')
+def index():
     return render_template('index.html')
 
 @app.route('/favicon.ico')
@@ -883,137 +3494,239 @@ def favicon():
 
 @app.route('/progress')
 def get_progress():
+    job_id = request.args.get('job_id')
+    if job_id:
+        return jsonify(job_progress.get(job_id, {'current': 0, 'total': 0, 'status': 'idle', 'message': ''}))
     return jsonify(progress_data)
 
 @app.route('/process', methods=['POST'])
 def process_pdfs():
-    global progress_data
-    
-    if 'files[]' not in request.files:
+    # Files the server already has may be sent by hash only (see /known)
+    known = parse_known(request.form)
+    error = known_error(known)
+    if error:
+        return jsonify(error[0]), error[1]
+    if 'files[]' not in request.files and not known:
         return jsonify({'error': 'No files provided'}), 400
     
     files = request.files.getlist('files[]')
     airline = request.form.get('airline', 'auto')
     
-    if not files:
+    if not files and not known:
         return jsonify({'error': 'No files selected'}), 400
+    if request.args.get('stream') not in (None, 'ndjson'):
+        return jsonify({'error': 'Unsupported stream format (use stream=ndjson)'}), 400
     
     # Check total file size (limit to 100MB total)
     total_size = sum(len(f.read()) for f in files)
     for f in files:
         f.seek(0)  # Reset file pointers
     
-    if total_size > 100 * 1024 * 1024:  # 100MB
+    if total_size > MAX_BATCH_BYTES:
         return jsonify({'error': 'Total file size exceeds 100MB limit'}), 413
     
     # Limit number of files
-    if len(files) > 50:
+    if len(files) > MAX_BATCH_FILES:
         return jsonify({'error': 'Maximum 50 files can be processed at once'}), 413
     
-    # Reset progress
-    progress_data = {'current': 0, 'total': len(files), 'status': 'processing', 'message': 'Starting...'}
+    # Rows already journaled by an earlier attempt of this job are not redone
+    job_id = resolve_job_id(request.form.get('job_id'))
+    journal = JobJournal(job_id)
+    done_hashes = journal.completed_hashes()
+    progress = track_progress(job_id, len(files) + len(known))
     
-    # Process files
-    all_data = []
+    # Uploads go to a scratch directory of this request, so concurrent
+    # requests (or one batch) with the same file name never share a path
+    scratch = ScratchDir(f'{job_id}-', app.config['UPLOAD_FOLDER'])
     
-    for idx, file in enumerate(files):
-        if file and allowed_file(file.filename):
-            progress_data['current'] = idx + 1
-            progress_data['message'] = f'Processing {file.filename}'
-            
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            
-            try:
-                # Auto-detect airline if needed
-                if airline == 'auto' or airline == 'any':
-                    detected_airline = detect_airline(filepath)
-                else:
-                    detected_airline = airline
-                
-                # Extract data based on airline
-                try:
-                    if detected_airline == 'airindia':
-                        extracted_data = extract_data_airindia(filepath)
-                    elif detected_airline == 'airindiaexpress':
-                        extracted_data = extract_data_airindiaexpress(filepath)
-                    elif detected_airline == 'kuwait':
-                        extracted_data = extract_data_kuwait(filepath)
-                    elif detected_airline == 'oman':
-                        extracted_data = extract_data_oman(filepath)
-                    elif detected_airline == 'qatar':
-                        extracted_data = extract_data_qatar(filepath)
-                    elif detected_airline == 'srilankan':
-                        extracted_data = extract_data_srilankan(filepath)
-                    elif detected_airline == 'turkish':
-                        extracted_data = extract_data_turkish(filepath)
-                    elif detected_airline == 'malaysia':
-                        extracted_data = extract_data_malaysia(filepath)
-                    elif detected_airline == 'akasa':
-                        extracted_data = extract_data_akasa(filepath)
-                    else:  # indigo or default
-                        extracted_data = extract_data_from_pdf(filepath)
-                
-                    # Add filename to extracted data
-                    extracted_data['File Name'] = filename
-                    all_data.append(extracted_data)
-                except Exception as extraction_error:
-                    all_data.append({
-                        'File Name': filename,
-                        'Airline': detected_airline.upper() if 'detected_airline' in locals() else 'UNKNOWN',
-                        'Error': str(extraction_error)
-                    })
-                
-            except Exception as e:
-                all_data.append({
-                    'File Name': filename,
-                    'Airline': 'ERROR',
-                    'Error': str(e)
-                })
-                all_data.append({
-                    'Airline': 'ERROR',
-                    'Number': filename,
-                    'Error': str(e)
-                })
-            
-            # Clean up uploaded file
+    # Rows as NDJSON while files finish instead of a workbook at the end
+    if request.args.get('stream') == 'ndjson':
+        saved = save_uploads(files, scratch.path)
+        
+        def generate():
             try:
-                os.remove(filepath)
-            except:
-                pass
+                yield from stream_records(saved, airline, job_id, journal, done_hashes, progress, known)
+            finally:
+                scratch.remove()
+        
+        return Response(generate(), mimetype='application/x-ndjson',
+                        headers={'X-Job-Id': job_id, 'Cache-Control': 'no-cache'})
     
-    # Create Excel file
     try:
-        df = pd.DataFrame(all_data)
-        
-        # Reorder columns
-        column_order = ['File Name', 'GSTIN', 'GSTIN of Customer', 'Number', 'GSTIN Customer Name', 
-                       'Date', 'PNR', 'From', 'To', 'Ticket Number', 'Taxable Value', 'CGST', 'SGST', 'IGST', 
-                       'Total(Incl Taxes)', 'Tax Summary']
-        
-        for col in column_order:
-            if col not in df.columns:
-                df[col] = ''
-        
-        df = df[column_order]
-        
-        # Save to Excel
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_filename = f'airline_invoices_{timestamp}.xlsx'
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        df.to_excel(output_path, index=False, engine='openpyxl')
+        process_known(known, job_id, journal, done_hashes, progress)
+        process_uploads(files, airline, job_id, journal, done_hashes, progress, scratch.path)
+    finally:
+        scratch.remove()
+    
+    
+    # Create Excel file from everything the job has journaled
+    try:
+        batch = journal.batch(skip_duplicates=app.config['DEDUP_MODE'] == 'skip')
+        output_path, output_filename = write_workbook(batch)
         
-        progress_data['status'] = 'complete'
-        progress_data['message'] = 'Processing complete!'
+        progress['status'] = 'complete'
+        progress['message'] = 'Processing complete!'
         
-        return send_file(output_path, as_attachment=True, download_name=output_filename)
+        response = send_file(output_path, as_attachment=True, download_name=output_filename)
+        response.headers['X-Job-Id'] = job_id
+        return response
         
     except Exception as e:
-        progress_data['status'] = 'error'
-        progress_data['message'] = f'Error creating Excel: {str(e)}'
-        return jsonify({'error': str(e)}), 500
+        progress['status'] = 'error'
+        progress['message'] = f'Error creating Excel: {str(e)}'
+        return jsonify({'error': str(e), 'job_id': job_id}), 500
+
+@app.route('/known', methods=['POST'])
+def known_files():
+    """Which of the posted SHA-256 file hashes the duplicate history can answer without an upload"""
+    hashes = (request.get_json(silent=True) or {}).get('hashes')
+    if not isinstance(hashes, list) or not all(isinstance(h, str) for h in hashes):
+        return jsonify({'error': 'Expected {"hashes": [...]}'}), 400
+    if len(hashes) > MAX_KNOWN_HASHES:
+        return jsonify({'error': f'At most {MAX_KNOWN_HASHES} hashes per request'}), 413
+    hashes = [h.lower() for h in hashes if FILE_HASH_PATTERN.match(h.lower())]
+    found = dedup_index.known(hashes)
+    return jsonify({'known': [h for h in hashes if h in found]})
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Start a chunked upload job; parts go to /jobs/<id>/files, then /jobs/<id>/finalize"""
+    job_id = resolve_job_id(request.form.get('job_id'))
+    job = load_job(job_id) or {
+        'airline': request.form.get('airline', 'auto'),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    with open(job_meta_path(job_id), 'w', encoding='utf-8') as f:
+        json.dump(job, f)
+    os.makedirs(job_spool_dir(job_id), exist_ok=True)
+    track_progress(job_id, 0)
+    return jsonify({'job_id': job_id}), 201
+
+@app.route('/jobs/<job_id>/files', methods=['POST'])
+def upload_job_part(job_id):
+    """Spool one part of a chunked upload and queue its files for extraction"""
+    job = load_job(job_id) if JOB_ID_PATTERN.match(job_id) else None
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    files = [f for f in request.files.getlist('files[]') if f and allowed_file(f.filename)]
+    known = parse_known(request.form)
+    error = known_error(known)
+    if error:
+        return jsonify(error[0]), error[1]
+    if not files and not known:
+        return jsonify({'error': 'No PDF files provided'}), 400
+    
+    spool_dir = job_spool_dir(job_id)
+    os.makedirs(spool_dir, exist_ok=True)
+    worker = spool_worker(job_id, job['airline'])
+    worker.progress['total'] += len(files) + len(known)
+    # Rows of files sent by hash are journaled right away
+    process_known(known, job_id, worker.journal, worker.done_hashes, worker.progress)
+    for file in files:
+        # The random prefix keeps same-named files of different parts apart
+        name = f'{uuid.uuid4().hex[:8]}_{secure_filename(file.filename)}'
+        file.save(os.path.join(spool_dir, name))
+        worker.submit(name)
+    return jsonify({'job_id': job_id, 'accepted': len(files), 'known': len(known),
+                    'progress': worker.progress}), 202
+
+@app.route('/jobs/<job_id>/finalize', methods=['POST'])
+def finalize_job(job_id):
+    """Finish a chunked upload job and return its workbook.
+
+    Files nobody has claimed yet (or whose claim went stale) are extracted
+    here, one at a time until FINALIZE_WAIT seconds have passed; if files are
+    still waiting or running then, the answer is 202 and the client repeats
+    the request.
+    """
+    job = load_job(job_id) if JOB_ID_PATTERN.match(job_id) else None
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    journal = JobJournal(job_id)
+    progress = job_progress.get(job_id) or track_progress(job_id, 0)
+    done_hashes = journal.completed_hashes()
+    deadline = time.time() + app.config['FINALIZE_WAIT']
+    while True:
+        reclaim_stale(job_id)
+        waiting, claimed = spool_entries(job_id)
+        for name in waiting:
+            if time.time() > deadline:
+                break
+            process_spooled(job_id, name, job['airline'], journal, done_hashes, progress)
+        if not waiting and not claimed:
+            break
+        if time.time() > deadline:
+            pending = sum(map(len, spool_entries(job_id)))
+            return jsonify({'job_id': job_id, 'status': 'processing', 'pending': pending,
+                            'progress': progress}), 202
+        time.sleep(0.5)
+    
+    release_spool_worker(job_id)
+    shutil.rmtree(job_spool_dir(job_id), ignore_errors=True)
+    
+    try:
+        batch = journal.batch(skip_duplicates=app.config['DEDUP_MODE'] == 'skip')
+        output_path, output_filename = write_workbook(batch)
+    except Exception as e:
+        progress['status'] = 'error'
+        progress['message'] = f'Error creating Excel: {str(e)}'
+        return jsonify({'error': str(e), 'job_id': job_id}), 500
+    
+    progress['status'] = 'complete'
+    progress['message'] = 'Processing complete!'
+    response = send_file(output_path, as_attachment=True, download_name=output_filename)
+    response.headers['X-Job-Id'] = job_id
+    return response
+
+@app.route('/jobs/<job_id>/workbook')
+def job_workbook(job_id):
+    """Rebuild the workbook of a job from its journal without re-uploading"""
+    if not JOB_ID_PATTERN.match(job_id):
+        return jsonify({'error': 'Invalid job id'}), 400
+    journal = JobJournal(job_id)
+    if not os.path.exists(journal.path):
+        return jsonify({'error': 'Unknown job'}), 404
+    try:
+        batch = journal.batch(skip_duplicates=app.config['DEDUP_MODE'] == 'skip')
+        output_path, output_filename = write_workbook(batch)
+    except Exception as e:
+        return jsonify({'error': str(e), 'job_id': job_id}), 500
+    return send_file(output_path, as_attachment=True, download_name=output_filename)
+
+@app.route('/invoices')
+def query_invoices():
+    """Query stored extractions: filters, optional group_by aggregation, paging"""
+    group_by = request.args.get('group_by')
+    if group_by and group_by not in ResultStore.GROUPS:
+        return jsonify({'error': f"group_by must be one of {', '.join(ResultStore.GROUPS)}"}), 400
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+    
+    results = result_store.query(
+        request.args,
+        group_by=group_by,
+        include_duplicates=request.args.get('include_duplicates') == '1',
+        limit=limit,
+        offset=offset
+    )
+    return jsonify({'results': results, 'count': len(results)})
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({'retention': dict(janitor.stats)})
+
+@app.route('/patterns')
+def patterns():
+    """Learned per-airline hit counts of the field patterns (?airline= name prefix)"""
+    return jsonify({
+        'frozen': pattern_stats.frozen,
+        'airlines': pattern_stats.report(request.args.get('airline')),
+    })
 
 if __name__ == '__main__':
+    start_janitor()
     app.run(host='0.0.0.0', port=5000, debug=True)
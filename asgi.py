@@ -0,0 +1,172 @@
+"""ASGI front end (Starlette) of the invoice extractor.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+
+Uploads, progress events and workbook downloads are handled on the event
+loop, so slow clients and progress streams do not hold a thread each. Every
+file is extracted by process_file on a bounded executor; the parse itself
+runs in an isolated child process (extract_records_isolated), which keeps
+the CPU-bound work off the loop with the same timeout and memory limits as
+the Flask app. Every other route (the page, chunked uploads, /invoices,
+/metrics, ...) is served by the Flask app mounted underneath.
+"""
+import asyncio
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.utils import secure_filename
+
+import app as core
+
+# Seconds /events waits for a job this worker process has not seen
+EVENTS_UNKNOWN_JOB_WAIT = 10
+
+# Files extracted at the same time across all requests of this worker
+extraction_pool = ThreadPoolExecutor(max_workers=core.app.config['EXTRACTION_WORKERS'], thread_name_prefix='extract')
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(extraction_pool, partial(func, *args))
+
+def save_upload(upload, path):
+    upload.file.seek(0)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(upload.file, f)
+
+def save_uploads(uploads, scratch_dir):
+    """Starlette counterpart of core.save_uploads: [(index, filename, path or None)]"""
+    saved = []
+    for idx, upload in enumerate(uploads):
+        filename = secure_filename(upload.filename)
+        path = None
+        if filename and core.allowed_file(filename):
+            path = os.path.join(scratch_dir, f'{idx:03d}_{filename}')
+            save_upload(upload, path)
+        saved.append((idx, filename or upload.filename, path))
+    return saved
+
+def build_workbook(journal):
+    batch = journal.batch(skip_duplicates=core.app.config['DEDUP_MODE'] == 'skip')
+    return core.write_workbook(batch)
+
+async def process(request):
+    """Same contract as the Flask /process route, including ?stream=ndjson"""
+    stream = request.query_params.get('stream')
+    if stream not in (None, 'ndjson'):
+        return JSONResponse({'error': 'Unsupported stream format (use stream=ndjson)'}, status_code=400)
+
+    async with request.form() as form:
+        files = [f for f in form.getlist('files[]') if getattr(f, 'filename', None)]
+        airline = form.get('airline', 'auto')
+        known = core.parse_known(form)
+        error = core.known_error(known)
+        if error:
+            return JSONResponse(error[0], status_code=error[1])
+        if not files and not known:
+            return JSONResponse({'error': 'No files provided'}, status_code=400)
+        if sum(f.size or 0 for f in files) > core.MAX_BATCH_BYTES:
+            return JSONResponse({'error': 'Total file size exceeds 100MB limit'}, status_code=413)
+        if len(files) > core.MAX_BATCH_FILES:
+            return JSONResponse({'error': 'Maximum 50 files can be processed at once'}, status_code=413)
+
+        job_id = core.resolve_job_id(form.get('job_id'))
+        journal = core.JobJournal(job_id)
+        done_hashes = journal.completed_hashes()
+        progress = core.track_progress(job_id, len(files) + len(known))
+
+        scratch = core.ScratchDir(f'{job_id}-', core.app.config['UPLOAD_FOLDER'])
+        if stream == 'ndjson':
+            saved = await run_blocking(save_uploads, files, scratch.path)
+
+            def lines():
+                try:
+                    yield from core.stream_records(saved, airline, job_id, journal, done_hashes, progress, known)
+                finally:
+                    scratch.remove()
+
+            # A sync iterator: Starlette pulls each line on its threadpool
+            return StreamingResponse(lines(), media_type='application/x-ndjson',
+                                     headers={'X-Job-Id': job_id, 'Cache-Control': 'no-cache'})
+
+        try:
+            await run_blocking(core.process_known, known, job_id, journal, done_hashes, progress)
+            for idx, upload in enumerate(files):
+                filename = secure_filename(upload.filename)
+                if not core.allowed_file(filename):
+                    continue
+                if core.is_archive(filename):
+                    await run_blocking(core.process_archive, upload.file, filename, airline,
+                                       job_id, journal, done_hashes, progress)
+                    continue
+
+                progress['current'] += 1
+                progress['message'] = f'Processing {upload.filename}'
+                filepath = os.path.join(scratch.path, f'{idx:03d}_{filename}')
+                await run_blocking(save_upload, upload, filepath)
+                await run_blocking(core.process_file, filepath, filename, airline,
+                                   job_id, journal, done_hashes)
+        finally:
+            scratch.remove()
+
+    try:
+        output_path, output_filename = await run_blocking(build_workbook, journal)
+    except Exception as e:
+        progress['status'] = 'error'
+        progress['message'] = f'Error creating Excel: {str(e)}'
+        return JSONResponse({'error': str(e), 'job_id': job_id}, status_code=500)
+
+    progress['status'] = 'complete'
+    progress['message'] = 'Processing complete!'
+    return FileResponse(output_path, filename=output_filename, headers={'X-Job-Id': job_id})
+
+async def events(request):
+    """Server-sent progress events of one job (or the latest job) until it finishes.
+
+    Progress lives in the memory of the worker process that runs the job, so
+    with --workers 2 a stream may land on a process that never sees it. A job
+    this process does not know within EVENTS_UNKNOWN_JOB_WAIT seconds ends
+    the stream with status 'unknown'; clients then poll GET /jobs/<id>/workbook.
+    """
+    job_id = request.query_params.get('job_id')
+
+    async def stream():
+        last = None
+        # The job may start just after the client subscribes
+        deadline = time.monotonic() + EVENTS_UNKNOWN_JOB_WAIT
+        while not await request.is_disconnected():
+            progress = core.job_progress.get(job_id) if job_id else core.progress_data
+            if not progress or progress['status'] == 'idle':
+                if time.monotonic() > deadline:
+                    yield 'data: ' + json.dumps({'current': 0, 'total': 0, 'status': 'unknown',
+                                                 'message': 'Job not running in this server process'}) + '\n\n'
+                    return
+                progress = {'current': 0, 'total': 0, 'status': 'idle', 'message': ''}
+            snapshot = json.dumps(progress)
+            if snapshot != last:
+                yield f'data: {snapshot}\n\n'
+                last = snapshot
+            if progress['status'] in ('complete', 'error'):
+                return
+            await asyncio.sleep(0.25)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@asynccontextmanager
+async def lifespan(app):
+    # The server process sweeps; importing this module (tests, scripts) does not
+    core.start_janitor()
+    yield
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route('/process', process, methods=['POST']),
+    Route('/events', events),
+    Mount('/', app=WSGIMiddleware(core.app)),
+])
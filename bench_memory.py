@@ -0,0 +1,41 @@
+"""Peak memory of PDF preprocessing with and without releasing pdfplumber page caches.
+
+    python bench_memory.py [pdf ...]
+
+Each measurement runs in a freshly spawned process, so one run's peak never
+leaks into the next. Reported numbers are the peak RSS growth (MB) while
+PDFPreprocessor.extract_content runs, on top of the already-imported app.
+"""
+import multiprocessing
+import resource
+import sys
+
+SAMPLES = ['malaysia5.PDF', 'Malaysia.PDF']
+
+def measure(pdf_path, release, conn):
+    import app
+    app.PDFPreprocessor.release_page_caches = release
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    preprocessor = app.PDFPreprocessor(pdf_path)
+    preprocessor.extract_content()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send(((after - before) / 1024, len(preprocessor.full_text), len(preprocessor.all_tables)))
+
+def run(pdf_path, release):
+    context = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(pdf_path, release, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or SAMPLES
+    print(f"{'file':<20}{'kept MB':>10}{'released MB':>14}{'saved':>8}")
+    for path in paths:
+        kept, text_kept, tables_kept = run(path, False)
+        released, text_released, tables_released = run(path, True)
+        assert (text_kept, tables_kept) == (text_released, tables_released), 'content differs'
+        saved = (1 - released / kept) * 100 if kept else 0
+        print(f'{path:<20}{kept:>10.1f}{released:>14.1f}{saved:>7.0f}%')
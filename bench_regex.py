@@ -0,0 +1,105 @@
+"""Time and lint every regex the extractor runs over document text.
+
+    python bench_regex.py [pdf ...]
+
+The sample PDFs are extracted once (with layout rules and pattern stats
+off, so every cascade runs in its written order) to collect each pattern
+the extractor searches with and the texts of the corpus. Every pattern is
+then timed, on the engine production uses, against every text and against
+the whole corpus joined and repeated REPEAT times: a search whose time
+grows faster than the text (growth exponent above MAX_GROWTH) is flagged
+super-linear. Lint warnings point at the constructs that usually cause
+backtracking. Exits 1 when any pattern is flagged, so it can gate CI.
+"""
+import glob
+import math
+import re
+import sys
+import time
+
+import app
+
+REPEAT = 8
+MAX_GROWTH = 1.5  # time ~ size ** growth; 1 is linear
+SLOW_SHARE = 0.1  # flag patterns whose slowest search uses this share of REGEX_TIMEOUT_MS
+
+NESTED_QUANTIFIER = re.compile(r'\((?:[^()\\]|\\.)*[+*]\)[+*{]')
+UPPER_CLASS = re.compile(r'\[[^\]]*A-Z[^\]]*\]')
+
+def collect(paths):
+    """(pattern, flags) pairs searched while extracting the corpus, and the texts searched"""
+    patterns, texts = {}, {}
+    search, findall = app.guarded_search, app.guarded_findall
+
+    def record(func):
+        def wrapper(pattern, text, flags=0):
+            patterns.setdefault((pattern, int(flags)), None)
+            if len(text) > 200:  # document text, not a cropped template region
+                texts.setdefault(text, None)
+            return func(pattern, text, flags)
+        return wrapper
+
+    app.guarded_search, app.guarded_findall = record(search), record(findall)
+    app.layout_rules.enabled = app.pattern_stats.enabled = False
+    try:
+        for path in paths:
+            airline = app.detect_airline(path)
+            app.extract_data_for_airline(path, airline)
+    finally:
+        app.guarded_search, app.guarded_findall = search, findall
+    return list(patterns), list(texts)
+
+def best_time(compiled, text, rounds=5):
+    best = math.inf
+    for _ in range(rounds):
+        start = time.perf_counter()
+        compiled.search(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def lint(pattern, flags):
+    warnings = []
+    if NESTED_QUANTIFIER.search(pattern):
+        warnings.append('nested quantifier')
+    if flags & re.IGNORECASE and UPPER_CLASS.search(pattern):
+        warnings.append('[A-Z] class under IGNORECASE matches any letter')
+    if re.search(r'\[\\s\\S\]\{\d+,\d+\}\?', pattern) and re.search(r'\[[^\]]*\\s[^\]]*\][+*]', pattern):
+        warnings.append('lazy [\\s\\S] gap before a class that also matches whitespace')
+    return warnings
+
+def audit(patterns, texts):
+    corpus = '\n'.join(texts)
+    budget = app.app.config['REGEX_TIMEOUT_MS'] / 1000
+    rows = []
+    for pattern, flags in patterns:
+        compiled = app.compile_pattern(pattern, flags)
+        slowest = max((best_time(compiled, text) for text in texts), default=0.0)
+        single = best_time(compiled, corpus)
+        repeated = best_time(compiled, corpus * REPEAT, rounds=2)
+        growth = math.log(max(repeated, 1e-7) / max(single, 1e-7)) / math.log(REPEAT)
+        flags_found = []
+        if growth > MAX_GROWTH and repeated > 1e-3:
+            flags_found.append(f'super-linear (x{REPEAT} text: x{repeated / single:.0f} time)')
+        if budget and slowest > budget * SLOW_SHARE:
+            flags_found.append(f'{slowest * 1000:.1f} ms on one document')
+        rows.append((slowest, repeated, pattern, flags, flags_found, lint(pattern, flags)))
+    rows.sort(key=lambda row: -row[1])
+    return rows
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or sorted(glob.glob('*.pdf') + glob.glob('*.PDF'))
+    patterns, texts = collect(paths)
+    rows = audit(patterns, texts)
+    corpus_kb = sum(len(text) for text in texts) / 1024
+    print(f'{len(patterns)} pattern(s), {len(texts)} document text(s), {corpus_kb:.0f} KB')
+    print(f"{'max/doc ms':>11}{f'x{REPEAT} ms':>10}  pattern")
+    flagged = 0
+    for slowest, repeated, pattern, flags, flags_found, warnings in rows:
+        print(f'{slowest * 1000:>11.3f}{repeated * 1000:>10.2f}  {pattern}')
+        for note in flags_found:
+            print(f'{"":>23}FLAG: {note}')
+        for note in warnings:
+            print(f'{"":>23}lint: {note}')
+        flagged += bool(flags_found)
+    print(f'{flagged} pattern(s) flagged')
+    sys.exit(1 if flagged else 0)
@@ -0,0 +1,114 @@
+"""Command line front end of the invoice extractor.
+
+    python cli.py extract november.zip extra/*.pdf -o november.xlsx
+    python cli.py replay --airline oman --dry-run
+    python cli.py patterns --airline kuwait
+
+Inputs may be PDFs, ZIP/tar.gz archives of PDFs or folders containing
+either. Rows are journaled under the job id exactly like /process, so an
+interrupted run can be resumed with --job-id. replay re-runs the current
+extraction rules over the result store from the parse cache, and patterns
+shows which field patterns win how often per airline.
+"""
+import argparse
+import os
+import shutil
+import sys
+
+from app import (
+    JobJournal, allowed_file, is_archive, pattern_stats, process_archive, process_file,
+    replay_history, resolve_job_id, track_progress, write_workbook, app
+)
+
+def iter_inputs(paths):
+    """Expand folders into the PDFs and archives below them"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if allowed_file(name):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def cmd_extract(args):
+    job_id = resolve_job_id(args.job_id)
+    journal = JobJournal(job_id)
+    done_hashes = journal.completed_hashes()
+    inputs = list(iter_inputs(args.inputs))
+    progress = track_progress(job_id, len(inputs))
+
+    for n, path in enumerate(inputs, 1):
+        name = os.path.basename(path)
+        print(f'[{n}/{len(inputs)}] {path}', file=sys.stderr)
+        if not allowed_file(name):
+            print('  skipped: not a PDF or archive', file=sys.stderr)
+            continue
+        with open(path, 'rb') as f:
+            if is_archive(name):
+                process_archive(f, name, args.airline, job_id, journal, done_hashes, progress)
+            else:
+                progress['current'] += 1
+                process_file(f.read(), name, args.airline, job_id, journal, done_hashes)
+
+    batch = journal.batch(skip_duplicates=app.config['DEDUP_MODE'] == 'skip')
+    output_path, output_filename = write_workbook(batch)
+    if args.output:
+        shutil.move(output_path, args.output)
+        output_path = args.output
+
+    errors = sum(1 for record in batch.records() if record.error)
+    print(f'{len(batch)} row(s), {errors} error(s) -> {output_path} (job {job_id})')
+    return 0
+
+def cmd_replay(args):
+    report = replay_history(args.airline, workers=args.workers, dry_run=args.dry_run)
+    for file_hash, (file_name, diffs) in sorted(report['diffs'].items(), key=lambda item: item[1][0]):
+        print(f'{file_name} ({file_hash[:12]})')
+        for column, (old, new) in diffs.items():
+            print(f'  {column}: {old!r} -> {new!r}')
+
+    action = 'would update' if args.dry_run else 'updated'
+    print(f"{report['replayed']} of {report['files']} file(s) replayed, "
+          f"{report['changed']} changed ({action}), {report['not_cached']} not in the parse cache")
+    return 0
+
+def cmd_patterns(args):
+    for airline, fields in pattern_stats.report(args.airline).items():
+        print(airline)
+        for field, entry in fields.items():
+            print(f"  {field}: {entry['runs']} run(s), {entry['misses']} without a match")
+            for row in entry['patterns']:
+                shadowed = f"  ({row['shadowed']} overruled)" if row['shadowed'] else ''
+                print(f"    {row['hits']:>6}  {row['rate']:>6.1%}  {row['pattern']}{shadowed}")
+    if pattern_stats.frozen:
+        print('(frozen: LEARNING_FROZEN=1)')
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Airline invoice PDF to Excel extractor')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    extract = commands.add_parser('extract', help='Extract PDFs, archives or folders into a workbook')
+    extract.add_argument('inputs', nargs='+', help='PDF files, .zip/.tar.gz archives or folders')
+    extract.add_argument('-o', '--output', help='Workbook path (default: a new file in outputs/)')
+    extract.add_argument('--airline', default='auto', help='Airline key, or auto to detect per file')
+    extract.add_argument('--job-id', help='Resume (or name) the job journal of this run')
+    extract.set_defaults(func=cmd_extract)
+
+    replay = commands.add_parser('replay', help='Re-run the current rules over stored extractions')
+    replay.add_argument('--airline', help='Only files of this airline (name prefix, e.g. oman)')
+    replay.add_argument('--workers', type=int, help='Worker processes (default: CPU count)')
+    replay.add_argument('--dry-run', action='store_true', help='Report diffs without updating the store')
+    replay.set_defaults(func=cmd_replay)
+
+    patterns = commands.add_parser('patterns', help='Show how often each field pattern matched per airline')
+    patterns.add_argument('--airline', help='Only this airline (name prefix, e.g. kuwait)')
+    patterns.set_defaults(func=cmd_patterns)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
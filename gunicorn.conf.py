@@ -0,0 +1,8 @@
+"""gunicorn settings, read from the working directory by `gunicorn app:app` (Procfile, railway.json)"""
+
+
+def post_worker_init(worker):
+    # Every worker may sweep, the janitor's lock file lets one at a time do it;
+    # cli.py and other importers of app never start it
+    from app import start_janitor
+    start_janitor()
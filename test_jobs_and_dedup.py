@@ -0,0 +1,133 @@
+"""Job journal, result store and duplicate handling through the Flask routes.
+
+Run with `python -m pytest test_jobs_and_dedup.py`. Each test works in a
+temporary directory with its own results database and job journals, on the
+sample invoices in this folder.
+"""
+import io
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import app as core
+
+SAMPLES = os.path.dirname(os.path.abspath(__file__))
+
+
+def sample(name, upload_name=None):
+    with open(os.path.join(SAMPLES, name), 'rb') as f:
+        return io.BytesIO(f.read()), upload_name or name
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # uploads/, outputs/, jobs/ and data/ are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    for folder in (core.UPLOAD_FOLDER, core.OUTPUT_FOLDER, core.JOBS_FOLDER, core.DATA_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+    # send_file resolves relative paths against the app's folder, not the working directory
+    monkeypatch.setitem(core.app.config, 'OUTPUT_FOLDER', str(tmp_path / core.OUTPUT_FOLDER))
+    monkeypatch.setattr(core, 'result_store', core.ResultStore(core.app.config['RESULTS_DB']))
+    monkeypatch.setattr(core, 'dedup_index', core.DuplicateIndex(core.app.config['RESULTS_DB'], 100))
+    # In-process extraction keeps the tests fast; the isolation itself is not under test
+    monkeypatch.setitem(core.app.config, 'EXTRACTION_ISOLATION', False)
+    return core.app.test_client()
+
+
+def process(client, files, **form):
+    response = client.post('/process', data={'airline': 'auto', 'files[]': files, **form},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.data
+    return response
+
+
+def workbook_rows(response):
+    return pd.read_excel(io.BytesIO(response.data)).fillna('').to_dict('records')
+
+
+def airline_totals(client):
+    return client.get('/invoices?group_by=airline').get_json()['results']
+
+
+def test_retry_extracts_only_failed_files_and_keeps_duplicate_uploads(client, monkeypatch):
+    extracted = []
+    extract = core.extract_records_isolated
+
+    def timing_out(pdf_path, filename, airline='auto', timeout=None, memory_mb=None):
+        extracted.append(filename)
+        if filename == 'airindia.pdf':
+            return [(None, core.InvoiceRecord(file_name=filename, airline='ERROR', error='Timed out after 120s'))]
+        return extract(pdf_path, filename, airline, timeout, memory_mb)
+
+    monkeypatch.setattr(core, 'extract_records_isolated', timing_out)
+    batch = lambda: [sample('qatar.pdf'), sample('qatar.pdf', 'qatar copy.pdf'), sample('airindia.pdf')]
+    job_id = process(client, batch()).headers['X-Job-Id']
+    journal = core.JobJournal(job_id)
+    # The second copy of the same bytes is answered from history, not parsed again
+    assert extracted == ['qatar.pdf', 'airindia.pdf']
+    assert [row['Error'] for row in journal.current_rows()] == ['', '', 'Timed out after 120s']
+
+    def counting(pdf_path, filename, airline='auto', timeout=None, memory_mb=None):
+        extracted.append(filename)
+        return extract(pdf_path, filename, airline, timeout, memory_mb)
+
+    monkeypatch.setattr(core, 'extract_records_isolated', counting)
+    extracted.clear()
+    rows = workbook_rows(process(client, batch(), job_id=job_id))
+    assert extracted == ['airindia.pdf']
+    assert [row['File Name'] for row in rows] == ['qatar.pdf', 'qatar_copy.pdf', 'airindia.pdf']
+    assert [row['Duplicate Of'] for row in rows] == ['', 'qatar.pdf', '']
+    assert 'ERROR' not in [row['Validation'] for row in rows]
+    assert len(journal.current_rows()) == 3
+    assert journal.completed_hashes() == {row['File Hash'] for row in journal.current_rows()}
+
+
+def test_known_resend_leaves_invoice_totals_unchanged(client):
+    job_id = process(client, [sample('qatar.pdf'), sample('airindia.pdf')]).headers['X-Job-Id']
+    totals = airline_totals(client)
+    assert [group['invoices'] for group in totals] == [1, 1]
+
+    known = [[row['File Hash'], row['File Name']] for row in core.JobJournal(job_id).current_rows()]
+    assert client.post('/known', json={'hashes': [h for h, _ in known]}).get_json()['known'] == [h for h, _ in known]
+    for _ in range(2):
+        response = process(client, [], known=json.dumps(known))
+        rows = workbook_rows(response)
+        assert [row['File Name'] for row in rows] == ['qatar.pdf', 'airindia.pdf']
+        assert not any(row['Duplicate Of'] for row in rows)
+        assert len(core.JobJournal(response.headers['X-Job-Id']).current_rows()) == 2
+    assert airline_totals(client) == totals
+
+
+def test_derived_total_reaches_store_stream_and_workbook(client):
+    rows = workbook_rows(process(client, [sample('airindia.pdf')]))
+    assert rows[0]['Total(Incl Taxes)'] == 8736
+    assert rows[0]['Validation'] == 'DERIVED Total(Incl Taxes)'
+
+    stored = client.get('/invoices?airline=AIR INDIA').get_json()['results']
+    assert [(row['total'], row['derived']) for row in stored] == [(8736.0, 'Total(Incl Taxes)')]
+
+    response = client.post('/process?stream=ndjson', data={'files[]': [sample('airindia.pdf', 'again.pdf')]},
+                           content_type='multipart/form-data')
+    line = json.loads(response.get_data(as_text=True).splitlines()[0])
+    assert line['rows'][0]['Total(Incl Taxes)'] == '8736.00'
+    assert line['rows'][0]['Derived'] == 'Total(Incl Taxes)'
+
+
+@pytest.mark.parametrize('mode, names, duplicates', [
+    ('flag', ['qatar.pdf', 'qatar_2.pdf'], ['', 'qatar.pdf']),
+    ('skip', ['qatar.pdf'], ['']),
+    ('off', ['qatar.pdf', 'qatar_2.pdf'], ['', '']),
+])
+def test_dedup_modes(client, monkeypatch, mode, names, duplicates):
+    # qatar (2).pdf is another file holding the same invoice as qatar.pdf
+    monkeypatch.setitem(core.app.config, 'DEDUP_MODE', mode)
+    monkeypatch.setattr(core, 'dedup_index', core.DuplicateIndex(
+        core.app.config['RESULTS_DB'], 100, enabled=mode != 'off'))
+    response = process(client, [sample('qatar.pdf'), sample('qatar (2).pdf')])
+    rows = workbook_rows(response)
+    assert [row['File Name'] for row in rows] == names
+    assert [row['Duplicate Of'] for row in rows] == duplicates
+    # The journal keeps every row; skip only leaves duplicates out of the workbook
+    assert len(core.JobJournal(response.headers['X-Job-Id']).current_rows()) == 2